@@ -26,79 +26,177 @@
 # This makes it easier to exclude stuff like
 # tmpfs mounts from disk usage reports.
 
-# Because tsdb does not like slashes in tags, slashes will
-# be replaced by underscores in the mount= tag.  In theory
-# this could cause problems if you have a mountpoint of
-# "/foo/bar/" and "/foo_bar/".
+# Mounts come from /proc/self/mountinfo, filtered like df -l does (no
+# remote or pseudo filesystems, one mount per device), and are read again
+# only once the kernel says the mount table changed.  Every mount gets
+# statvfs() in its own thread, so a hung NFS or FUSE mount only loses its
+# own metrics; it is skipped until that call returns.
 
 
+import errno
 import os
-import socket
-import subprocess
+import select
 import sys
+import threading
 import time
 
+from tags import tag_value
+
 
 COLLECTION_INTERVAL = 60  # seconds
 
+MOUNTINFO = "/proc/self/mountinfo"
+# seconds statvfs() of one mount may take
+MOUNT_TIMEOUT = 5
+
+# Skip mounts/types we don't care about.
+# Most of this stuff is of type tmpfs, but we don't
+# want to blacklist all tmpfs since sometimes it's
+# used for active filesystems (/var/run, /tmp)
+# that we do want to track.
+SKIP_TYPES = ("debugfs", "devtmpfs")
+# what df leaves out without -a, statvfs() of autofs would even mount it
+PSEUDO_TYPES = ("autofs", "bpf", "cgroup", "cgroup2", "configfs", "devpts",
+                "fusectl", "hugetlbfs", "mqueue", "proc", "pstore",
+                "rootfs", "rpc_pipefs", "securityfs", "sysfs", "tracefs",
+                "binfmt_misc", "nsfs", "efivarfs", "selinuxfs")
+# what df -l leaves out, as well as devices with a host: in their name
+REMOTE_TYPES = ("nfs", "nfs4", "cifs", "smbfs", "smb3", "afs", "ncpfs",
+                "ceph", "glusterfs", "9p")
+
+
+class Mount(object):
+    __slots__ = ("path", "fstype", "dev")
+
+    def __init__(self, path, fstype, dev):
+        self.path = path
+        self.fstype = fstype
+        self.dev = dev
+
+
+def unescape(path):
+    """Decodes the octal escapes of spaces and such in mountinfo."""
+    if "\\" not in path:
+        return path
+    return path.decode("string_escape")
+
+
+def parse_mountinfo(text):
+    """Returns the mounts to report on, one per device."""
+    by_path = {}
+    for line in text.splitlines():
+        mount, sep, fs = line.partition(" - ")
+        mount = mount.split()
+        fs = fs.split()
+        if not sep or len(mount) < 5 or len(fs) < 2:
+            continue
+        dev, path = mount[2], unescape(mount[4])
+        fstype, source = fs[0], fs[1]
+        if (fstype in SKIP_TYPES or fstype in PSEUDO_TYPES
+                or fstype in REMOTE_TYPES or ":" in source
+                or source.startswith("//")):
+            continue
+        if path == "/dev" or path.startswith("/lib/") \
+                or path.startswith("/dev/"):
+            continue
+        # the last one mounted on a path hides the others
+        by_path[path] = Mount(path, fstype, dev)
+    # bind mounts show the same filesystem again, keep its shortest path
+    by_dev = {}
+    for mount in by_path.itervalues():
+        other = by_dev.get(mount.dev)
+        if other is None or len(mount.path) < len(other.path):
+            by_dev[mount.dev] = mount
+    return sorted(by_dev.itervalues(), key=lambda mount: mount.path)
+
+
+class MountTable(object):
+    """The mounts to report on, parsed again only when the kernel reports a
+    change of the mount table by poll() on mountinfo."""
+
+    def __init__(self, path=MOUNTINFO):
+        self.file = open(path)
+        self.poller = select.poll()
+        self.poller.register(self.file, select.POLLPRI | select.POLLERR)
+        self.mounts = None
+
+    def get(self):
+        if self.mounts is None or self.poller.poll(0):
+            self.file.seek(0)
+            self.mounts = parse_mountinfo(self.file.read())
+        return self.mounts
+
+
+# kept while in-process, so runs after the first skip the parsing
+mount_table = None
+# mount path -> thread still stuck in statvfs() since an earlier run
+hung = {}
+
+
+def statvfs_all(mounts, timeout):
+    """Returns {path: statvfs result} of the mounts that answered within
+    timeout seconds."""
+    results = {}
+
+    def call(path):
+        try:
+            results[path] = os.statvfs(path)
+        except OSError, e:
+            if e.errno not in (errno.ENOENT, errno.EACCES, errno.ESTALE):
+                print >> sys.stderr, "statvfs(%s) failed: %s" % (path, e)
+
+    threads = []
+    for mount in mounts:
+        stuck = hung.get(mount.path)
+        if stuck is not None:
+            if stuck.isAlive():
+                continue
+            del hung[mount.path]
+        thread = threading.Thread(target=call, args=(mount.path,))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append((mount.path, thread))
+    deadline = time.time() + timeout
+    for path, thread in threads:
+        thread.join(max(0, deadline - time.time()))
+        if thread.isAlive():
+            print >> sys.stderr, "statvfs(%s) hangs, skipping it" % path
+            hung[path] = thread
+    return results
+
+
+def collect(confs_dir=None):
+    """Yields (metric, timestamp, value, tags) of every mount."""
+    global mount_table
+    if mount_table is None:
+        mount_table = MountTable()
+    mounts = mount_table.get()
+    results = statvfs_all(mounts, MOUNT_TIMEOUT)
+    ts = int(time.time())
+    for mount in mounts:
+        st = results.get(mount.path)
+        # like df, leave out what has no blocks at all
+        if st is None or not st.f_blocks:
+            continue
+        tags = "mount=%s fstype=%s" % (tag_value(mount.path),
+                                        tag_value(mount.fstype))
+        kb = st.f_frsize / 1024.0
+        yield ("df.1kblocks.total", ts, int(st.f_blocks * kb), tags)
+        yield ("df.1kblocks.used", ts, int((st.f_blocks - st.f_bfree) * kb),
+               tags)
+        yield ("df.1kblocks.free", ts, int(st.f_bavail * kb), tags)
+        # some filesystems (btrfs, vfat) have no fixed number of inodes
+        if st.f_files:
+            yield ("df.inodes.total", ts, st.f_files, tags)
+            yield ("df.inodes.used", ts, st.f_files - st.f_ffree, tags)
+            yield ("df.inodes.free", ts, st.f_ffree, tags)
+
+
 def main():
-        ts = int(time.time())
-        # 1kblocks
-        df_proc = subprocess.Popen(["df", "-PlTk"], stdout=subprocess.PIPE)
-        stdout, _ = df_proc.communicate()
-        if df_proc.returncode == 0:
-            for line in stdout.split("\n"): # pylint: disable=E1103
-                fields = line.split()
-                # skip header/blank lines
-                if not line or not fields[2].isdigit():
-                    continue
-                # Skip mounts/types we don't care about.
-                # Most of this stuff is of type tmpfs, but we don't
-                # want to blacklist all tmpfs since sometimes it's
-                # used for active filesystems (/var/run, /tmp)
-                # that we do want to track.
-                if fields[1] in ("debugfs", "devtmpfs"):
-                    continue
-                if fields[6] == "/dev":
-                    continue
-                # /dev/shm, /lib/init_rw, /lib/modules, etc
-                #if fields[6].startswith(("/lib/", "/dev/")):  # python2.5+
-                if fields[6].startswith("/lib/"):
-                    continue
-                if fields[6].startswith("/dev/"):
-                    continue
-
-                mount = fields[6]
-                print ("df.1kblocks.total %d %s mount=%s fstype=%s"
-                       % (ts, fields[2], mount, fields[1]))
-                print ("df.1kblocks.used %d %s mount=%s fstype=%s"
-                       % (ts, fields[3], mount, fields[1]))
-                print ("df.1kblocks.free %d %s mount=%s fstype=%s"
-                       % (ts, fields[4], mount, fields[1]))
-        else:
-            print >> sys.stderr, "df -Pltk returned %r" % df_proc.returncode
-
-        ts = int(time.time())
-        # inodes
-        df_proc = subprocess.Popen(["df", "-PlTi"], stdout=subprocess.PIPE)
-        stdout, _ = df_proc.communicate()
-        if df_proc.returncode == 0:
-            for line in stdout.split("\n"): # pylint: disable=E1103
-                fields = line.split()
-                if not line or not fields[2].isdigit():
-                    continue
-
-                mount = fields[6]
-                print ("df.inodes.total %d %s mount=%s fstype=%s"
-                       % (ts, fields[2], mount, fields[1]))
-                print ("df.inodes.used %d %s mount=%s fstype=%s"
-                       % (ts, fields[3], mount, fields[1]))
-                print ("df.inodes.free %d %s mount=%s fstype=%s"
-                       % (ts, fields[4], mount, fields[1]))
-        else:
-            print >> sys.stderr, "df -Plti returned %r" % df_proc.returncode
-
-        sys.stdout.flush()
+    for metric, ts, value, tags in collect():
+        print "%s %d %s %s" % (metric, ts, value, tags)
+
+    sys.stdout.flush()
 
 if __name__ == "__main__":
     main()
@@ -1,14 +1,16 @@
 #!/usr/bin/env python
 import ConfigParser
-import StringIO
 import json
 import string
 import sys
 import os.path
+import urllib
 import urllib2
 import re
+import zlib
 from string import split, join
 import itertools
+import threading
 import time
 
 #!/usr/bin/python
@@ -25,7 +27,141 @@ import time
 # of the GNU Lesser General Public License along with this program.  If not,
 # see <http://www.gnu.org/licenses/>.
 
-DEFAULT_TIMEOUT = 30
+# seconds to fetch and parse one section, "timeout" in the section
+# overrides it; sections are fetched concurrently
+DEFAULT_TIMEOUT = 10
+
+# An endpoint failing FAILURES runs in a row is left alone for BACKOFF
+# seconds, twice as long after every retry that fails too up to
+# MAX_BACKOFF, so a dead daemon doesn't cost its timeout on every run.
+# The state is kept in the collector's cache dir, in BREAKERS_FILE.
+FAILURES = 3
+BACKOFF = 60
+MAX_BACKOFF = 3600
+CACHE_DIR_ENV = "OPENTSDB_CHECKS_CACHE_DIR"
+BREAKERS_FILE = "hadoop.breakers"
+# seconds given to a fetch past its timeout to report it on its own
+GRACE = 1
+
+# what to make of the beans of each daemon, see there; hadoop.rules in
+# the config dir replaces it
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib',
+                          'hadoop.rules')
+
+# Each class asks the JMX servlet only for the beans it uses, with a ?qry=
+# per JMX ObjectName pattern in its queries, gzipped, and decodes them one
+# at a time as they arrive, keeping none it doesn't use.  Other urls, e.g.
+# file: ones, are read whole and filtered here.
+JVM_QUERIES = ('java.lang:type=Memory', 'java.lang:type=GarbageCollector,*')
+READ_SIZE = 64 * 1024
+BEANS_START = re.compile(r'\s*\{\s*"beans"\s*:\s*\[')
+BEANS_SEPARATOR = re.compile(r'[\s,]*')
+# a rule whose pattern has these is matched on its own: in a regular
+# expression of several rules, numbered backreferences and conditionals
+# would count the groups of the rules before it (and named groups could
+# clash). Errs on the safe side, e.g. on an escaped backslash and a digit.
+OWN_GROUPS = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?\(')
+
+
+def query_matcher(query):
+    """Returns a function telling whether a bean name matches query, a JMX
+    ObjectName pattern like "Hadoop:service=NameNode,*" (without wildcards
+    in the domain or the values)."""
+    domain, _, props = query.partition(':')
+    props = set(props.split(','))
+    wildcard = '*' in props
+    props.discard('*')
+
+    def matches(name):
+        bean_domain, _, bean_props = name.partition(':')
+        if bean_domain != domain:
+            return False
+        bean_props = set(bean_props.split(','))
+        if wildcard:
+            return props <= bean_props
+        return props == bean_props
+    return matches
+
+
+def read_chunks(response):
+    """Yields what response has, gunzipped if it comes gzipped."""
+    decompress = None
+    if response.info().get('Content-Encoding') == 'gzip':
+        decompress = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+    while True:
+        data = response.read(READ_SIZE)
+        if not data:
+            return
+        if decompress:
+            data = decompress(data)
+        yield data
+
+
+def iter_beans(chunks):
+    """Yields the beans of a JMX servlet response read as chunks, decoding
+    each one as soon as it's complete."""
+    decoder = json.JSONDecoder()
+    data = ''
+    pos = None
+    # bytes needed before trying again to decode a bean that was cut, so
+    # a big one is decoded a few times, not once per chunk
+    wanted = 0
+    # '' at the end for whatever is left
+    for chunk in itertools.chain(chunks, ['']):
+        data += chunk
+        if chunk and len(data) < wanted:
+            continue
+        if pos is None:
+            m = BEANS_START.match(data)
+            if not m:
+                if chunk and len(data) < READ_SIZE:
+                    continue
+                raise ValueError('Not a JMX servlet response')
+            pos = m.end()
+        while True:
+            pos = BEANS_SEPARATOR.match(data, pos).end()
+            if pos == len(data):
+                break
+            if data[pos] == ']':
+                return
+            try:
+                bean, pos = decoder.raw_decode(data, pos)
+            except ValueError:
+                # cut, read on
+                break
+            yield bean
+        data = data[pos:]
+        pos = 0
+        wanted = 2 * len(data)
+    raise ValueError('Truncated JMX servlet response')
+
+
+def fetch_beans(url, queries, timeout):
+    """Yields the beans of the JMX servlet at url matching one of queries,
+    in timeout seconds."""
+    deadline = time.time() + timeout
+    if url.startswith('http:') or url.startswith('https:'):
+        separator = '?' in url and '&' or '?'
+        requests = [(url + separator + 'qry=' + urllib.quote(query, ':=,*'),
+                     [query_matcher(query)])
+                    for query in queries]
+    else:
+        requests = [(url, map(query_matcher, queries))]
+    for request_url, matchers in requests:
+        request = urllib2.Request(request_url,
+                                  headers={'Accept-Encoding': 'gzip'})
+        response = urllib2.urlopen(request,
+                                   timeout=max(deadline - time.time(), 0.1))
+        try:
+            for bean in iter_beans(read_chunks(response)):
+                name = bean.get('name', '')
+                for matches in matchers:
+                    if matches(name):
+                        yield bean
+                        break
+        finally:
+            response.close()
+
 
 class Bean(object):
     def __init__(self, bean):
@@ -39,12 +175,119 @@ class Bean(object):
     def __str__(self):
         return self.bean['name'] + ":" + self.sys + "," + str(self.tags)
 
+class Rules(object):
+    """A section of the rules file, compiled: consecutive rules are tried
+    at once by a single regular expression (see OWN_GROUPS for the ones
+    that aren't), and what an attribute maps to is remembered by name."""
+
+    def __init__(self, config, section):
+        self.process = config.get(section, 'process')
+        self.prefix = config.get(section, 'prefix')
+        self.beans = config.get(section, 'beans').split()
+        self.json = []
+        if config.has_option(section, 'json'):
+            self.json = config.get(section, 'json').split()
+        # (match, {group: rule}) in the order of the rules, a rule being
+        # (regexp, metric, [(tag, value)]); group is the group of the rule
+        # in match, or None for a rule matched by its own regexp
+        self.matchers = []
+        patterns = []
+        rules = {}
+        group = 1
+        for line in config.get(section, 'rules').splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) < 2:
+                raise ValueError('No metric in rule %r of %s' % (line, section))
+            try:
+                regexp = re.compile('(?:%s)$' % fields[0])
+            except re.error, e:
+                raise ValueError('Bad pattern in rule %r of %s: %s'
+                                 % (line, section, e))
+            tags = [tuple(tag.split('=', 1)) for tag in fields[2:]]
+            rule = (regexp, fields[1], tags)
+            if regexp.groupindex or OWN_GROUPS.search(fields[0]):
+                self.add_matcher(patterns, rules)
+                patterns, rules, group = [], {}, 1
+                self.matchers.append((regexp.match, {None: rule}))
+                continue
+            rules[group] = rule
+            patterns.append('((?:%s)$)' % fields[0])
+            group += 1 + regexp.groups
+        self.add_matcher(patterns, rules)
+        # attribute name -> (metric, tags) or None
+        self.mapped = {}
+
+    def add_matcher(self, patterns, rules):
+        # alternatives are tried in order, and the group of a rule is the
+        # last one to close when it matches
+        if patterns:
+            self.matchers.append((re.compile('|'.join(patterns)).match, rules))
+
+    def map(self, attr):
+        """Returns (metric, [(tag, value)]) for attribute attr, or None if
+        it's dropped."""
+        try:
+            return self.mapped[attr]
+        except KeyError:
+            pass
+        result = None
+        for match, rules in self.matchers:
+            m = match(attr)
+            if m:
+                regexp, metric, tags = rules.get(m.lastindex) or rules[None]
+                if metric != '-':
+                    m = regexp.match(attr)
+                    result = (self.prefix + m.expand(metric),
+                              [(tag, m.expand(value)) for tag, value in tags])
+                break
+        self.mapped[attr] = result
+        return result
+
+    def attrs(self, bean):
+        """Yields the (name, value) pairs of bean to map."""
+        if not self.json:
+            for attr, value in bean.iteritems():
+                yield attr.encode('latin'), value
+            return
+        for attr in self.json:
+            if attr in bean:
+                for item in json_fields(json.loads(bean[attr])):
+                    yield item
+
+
+def json_fields(obj, prefix=''):
+    for name, value in obj.iteritems():
+        name = prefix + name.encode('latin')
+        if isinstance(value, dict):
+            for item in json_fields(value, name + '.'):
+                yield item
+        else:
+            yield name, value
+
+
+def read_rules(confs_dir):
+    """Returns the Rules of the daemons, in the order of the rules file."""
+    path = os.path.join(confs_dir, 'hadoop.rules')
+    if not os.path.exists(path):
+        path = RULES_FILE
+    config = ConfigParser.RawConfigParser()
+    if not config.read(path):
+        raise IOError('Cannot read %s' % path)
+    return [(section, Rules(config, section)) for section in config.sections()]
+
+
 class JmxParser(object):
-    def __init__(self, url, conf):
+
+    def __init__(self, url, conf, rules, timeout=DEFAULT_TIMEOUT):
         self.url = url
         self.conf = conf
-        f = urllib2.urlopen(self.url, timeout=DEFAULT_TIMEOUT)
-        self.beans = map(lambda x: Bean(x), json.load(f)['beans'])
+        self.rules = rules
+        self.beans = map(lambda x: Bean(x),
+                         fetch_beans(self.url,
+                                     JVM_QUERIES + tuple(rules.beans), timeout))
 
     def find_beans(self, sys, **kwargs):
         return filter(lambda x: (x.sys == sys and self.has_tags(x, **kwargs)), self.beans)
@@ -56,18 +299,6 @@ class JmxParser(object):
                 return False
         return True
 
-    def iter_attrs(self, bean, *regexps):
-        for (attr, v) in bean.iteritems():
-            for attr_regex in regexps:
-                if re.match(attr_regex, attr):
-                    yield attr, v
-
-    def filter_attrs(self, bean, attr_regexps):
-        for (attr, value) in bean.bean.iteritems():
-            for regex in attr_regexps:
-                if re.match(regex, attr):
-                    yield attr.encode('latin'), value
-
     def get_jvm_metrics(self, tags):
         for bean in self.find_beans('java.lang', type='^Memory$'):
             for t, v in bean.bean['HeapMemoryUsage'].iteritems():
@@ -84,170 +315,89 @@ class JmxParser(object):
             yield 'jvm.memory.gc.count', ltags, str(bean.bean['CollectionCount'])
             yield 'jvm.memory.gc.time', ltags, str(bean.bean['CollectionTime'])
 
-class HDFSNameNode(JmxParser):
-
-    what = { '.*': [
-        '.*AvgTime',
-        '.*NumOps',
-        '^Total[A-Z]+',
-        '^Files[A-Z]+',
-        '^Capacity.*GB',
-        '^Threads',
-        '.*Blocks$'
-    ] }
-
     def get_metrics(self):
-        for m in self.get_jvm_metrics({'process' : 'NameNode'}):
+        for m in self.get_jvm_metrics({'process' : self.rules.process}):
             yield m
-        for (name, attr_regexps) in self.what.iteritems():
-            for bean in self.find_beans('Hadoop', service='NameNode', name=name):
-                for (attr, value) in self.filter_attrs(bean, attr_regexps):
-                    tags = {}
-                    if attr.endswith('NumOps'):
-                        tags['op'] = attr[:-6]
-                        attr = 'numOps'
-                    elif attr.endswith('AvgTime'):
-                        tags['op'] = attr[:-7]
-                        attr = 'avgTime'
-                    elif attr.endswith('Blocks'):
-                        tags['state'] = attr[:-6]
-                        attr = 'blocks'
-                    elif attr.startswith('Total'):
-                        if attr[5:] == 'Load':
-                            continue
-                        tags['type'] = attr[5:]
-                        attr = 'count'
-                    elif attr.startswith('Files'):
-                        if attr[5:] == 'Total':
-                            continue
-                        tags['op'] = attr[5:]
-                        attr = 'files'
-                    elif attr.startswith('Threads'):
-                        if attr[7:] == '':
-                            continue
-                        tags['type'] = attr[7:]
-                        attr = 'threads'
-                    elif attr.startswith('Capacity'):
-                        if attr[8:] == 'TotalGB':
-                            attr = 'capacity.total'
-                        else:
-                            tags['type'] = attr[8:]
-                            attr = 'capacity'
-
-                    yield 'hadoop.namenode.' + attr, tags, str(value)
-
-class HDFSDataNode(JmxParser):
-
-    what = { '.*': [
-        '.*AvgTime$',
-        '.*NumOps$',
-        '.*Client$',
-        '^Threads',
-        '^Blocks',
-        '^Bytes'
-    ] }
+        for query in self.rules.beans:
+            matches = query_matcher(query)
+            for bean in self.beans:
+                if not matches(bean.bean['name']):
+                    continue
+                for (attr, value) in self.rules.attrs(bean.bean):
+                    mapped = self.rules.map(attr)
+                    if mapped:
+                        metric, tags = mapped
+                        yield metric, dict(tags), str(value)
 
-    def get_metrics(self):
-        for m in self.get_jvm_metrics({'process' : 'DataNode'}):
-            yield m
-        for (name, attr_regexps) in self.what.iteritems():
-            for bean in self.find_beans('Hadoop', service='DataNode', name=name):
-                for (attr, value) in self.filter_attrs(bean, attr_regexps):
-                    tags = {}
-                    if attr.endswith('NumOps'):
-                        tags['op'] = attr[:-6]
-                        attr = 'numOps'
-                    elif attr.endswith('AvgTime'):
-                        tags['op'] = attr[:-7]
-                        attr = 'avgTime'
-                    elif attr.endswith('Client'):
-                        tags['op'] = attr[6:]
-                        attr = 'client'
-                    elif attr.startswith('Blocks'):
-                        tags['type'] = attr[6:]
-                        attr = 'blocks'
-                    elif attr.startswith('Bytes'):
-                        tags['type'] = attr[5:]
-                        attr = 'bytes'
-                    elif attr.startswith('Threads'):
-                        if attr[7:] == '':
-                            continue
-                        tags['type'] = attr[7:]
-                        attr = 'threads'
-
-                    yield 'hadoop.datanode.' + attr, tags, str(value)
-
-class HBaseRegionServer(JmxParser):
-
-    what = { 'RegionServerStatistics': ['.*'] }
-
-    def get_metrics(self):
-        for m in self.get_jvm_metrics({'process' : 'HRegionServer'}):
-            yield m
-        for (name, attr_regexps) in self.what.iteritems():
-            for bean in self.find_beans('hadoop', service='RegionServer', name=name):
-                for (attr, value) in self.filter_attrs(bean, attr_regexps):
-                    tags = {}
-                    if attr.endswith('NumOps'):
-                        tags['op'] = attr[:-6]
-                        attr = 'numOps'
-                    elif attr.endswith('AvgTime'):
-                        tags['op'] = attr[:-7]
-                        attr = 'avgTime'
-                    elif attr.endswith('MaxTime'):
-                        tags['op'] = attr[:-7]
-                        attr = 'maxTime'
-                    elif attr.endswith('MinTime'):
-                        continue
-                    elif 'Latency' in attr:
-                        parts = attr.split('_')
-                        if len(parts) != 2:
-                            continue
-                        attr = parts[0].replace('Latency','')
-                        tags['type'] = parts[1]
-
-                    yield 'hbase.regionserver.' + attr, tags, str(value)
-
-class JobTracker(JmxParser):
-
-    def get_metrics(self):
-        for m in self.get_jvm_metrics({'process' : 'JobTracker'}):
-            yield m
-        for bean in self.find_beans('hadoop', service='JobTracker', name='JobTrackerInfo'):
-            strio = StringIO.StringIO(bean.bean['SummaryJson'])
-            for attr, value in json.load(strio).iteritems():
-                if attr in ['nodes']:
-                    yield 'hadoop.jobtracker.nodes' + attr, {}, str(value)
-                elif attr in ['alive', 'blacklisted']:
-                    yield 'hadoop.jobtracker.nodes.active', {'state' : attr}, str(value)
-                elif attr == 'slots':
-                    for s, v in value.iteritems():
-                        if s.endswith('_used'):
-                            yield 'hadoop.jobtracker.slots.used',\
-                                {'type': s.split('_', 1)[0]}, str(v)
-                        else:
-                            yield 'hadoop.jobtracker.slots.total',\
-                                {'type': s.split('_', 1)[0]}, str(v)
-
-
-
-class TaskTracker(JmxParser):
-
-    def get_metrics(self):
-        for m in self.get_jvm_metrics({'process' : 'TaskTracker'}):
-            yield m
-        for bean in self.find_beans('hadoop', service='TaskTracker', name='TaskTrackerInfo'):
-            strio = StringIO.StringIO(bean.bean['TasksInfoJson'])
-            for attr, value in json.load(strio).iteritems():
-                yield 'hadoop.tasktracker.tasks', {'state' : attr}, str(value)
 
 def format_tags(tags):
     return string.join(map(
         lambda (tag, tagv): "%s=%s" % (tag, tagv),
         tags.items()), ' ')
 
-def print_metrics(config, ts, section, clz):
-    metrics = list(clz(config.get(section, 'url'), config).get_metrics())
+class Breakers(object):
+    """Circuit breakers of the endpoints: by url, the failures in a row and
+    the time until which it's left alone."""
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        if not path:
+            return
+        try:
+            f = open(path)
+            try:
+                self.state = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            pass
+
+    def allows(self, url, now):
+        return self.state.get(url, (0, 0))[1] <= now
+
+    def success(self, url):
+        self.state.pop(url, None)
+
+    def failure(self, url, now):
+        """Counts a failure, returns how long url is then left alone."""
+        failures = self.state.get(url, (0, 0))[0] + 1
+        if failures < FAILURES:
+            self.state[url] = (failures, 0)
+            return 0
+        backoff = min(BACKOFF * 2 ** min(failures - FAILURES, 16), MAX_BACKOFF)
+        self.state[url] = (failures, now + backoff)
+        return backoff
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        f = open(tmp, 'w')
+        try:
+            json.dump(self.state, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+
+def breakers_path():
+    """None when not run by the collector, then nothing is remembered."""
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, BREAKERS_FILE)
+
+
+def fetch_metrics(results, section, rules, url, config, timeout):
+    try:
+        results[section] = list(JmxParser(url, config, rules,
+                                          timeout).get_metrics())
+    except Exception, e:
+        results[section] = e
+
+
+def print_metrics(ts, metrics):
     lines = map(lambda (metric, tags, value): "%s %d %s %s" % (metric, ts, value, format_tags(tags)), metrics)
     lines.sort()
     for line in lines:
@@ -263,19 +413,48 @@ def main(argv):
     config = ConfigParser.SafeConfigParser()
     config.read(confpath)
     ts = int(time.time())
-
-    for sec, clz in {'NameNode' : HDFSNameNode,
-                     'DataNode' : HDFSDataNode,
-                     'HBaseRegionServer' : HBaseRegionServer,
-                     'JobTracker' : JobTracker,
-                     'TaskTracker' : TaskTracker
-    }.iteritems():
-        try:
-            if config.has_section(sec):
-                print_metrics(config, ts, sec, clz)
-        except:
+    breakers = Breakers(breakers_path())
+    daemons = read_rules(argv[1])
+
+    # a thread per section, each given its own timeout
+    results = {}
+    fetches = []
+    for sec, rules in daemons:
+        if not config.has_section(sec):
             continue
-
+        url = config.get(sec, 'url')
+        if not breakers.allows(url, time.time()):
+            continue
+        timeout = DEFAULT_TIMEOUT
+        if config.has_option(sec, 'timeout'):
+            timeout = config.getfloat(sec, 'timeout')
+        thread = threading.Thread(target=fetch_metrics,
+                                  args=(results, sec, rules, url, config,
+                                        timeout))
+        # one that hangs past its timeout is left behind
+        thread.setDaemon(True)
+        thread.start()
+        fetches.append((sec, url, time.time() + timeout + GRACE, thread))
+
+    for sec, url, deadline, thread in fetches:
+        thread.join(max(deadline - time.time(), 0))
+        result = results.get(sec)
+        if thread.isAlive():
+            result = "timed out"
+        if isinstance(result, list):
+            breakers.success(url)
+            print_metrics(ts, result)
+            continue
+        backoff = breakers.failure(url, time.time())
+        print >>sys.stderr, "Failed to get %s metrics from %s: %s%s" % (
+            sec, url, result,
+            backoff and ", leaving it alone for %d s" % backoff or "")
+    sys.stdout.flush()
+
+    try:
+        breakers.save()
+    except (IOError, OSError), e:
+        print >>sys.stderr, "Failed to save %s: %s" % (breakers.path, e)
 
 
 def get_or_default(config, section, key, default_value):
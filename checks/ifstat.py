@@ -20,6 +20,7 @@ import time
 import socket
 import re
 
+import procfs
 
 # /proc/net/dev has 16 fields, 8 for receive and 8 for xmit
 # The fields we care about are defined here.  The
@@ -30,30 +31,33 @@ import re
 
 FIELDS = ("bytes", "packets", "errs", "dropped",
            None, None, None, None,)
+IFACE_RE = re.compile("(vlan|eth)\d+$")
 
-def main():
+def collect(confs_dir=None):
+    """Yields (metric, timestamp, value, tags) for /proc/net/dev."""
 
     # We just care about ethN interfaces.  We specifically
     # want to avoid bond interfaces, because interface
     # stats are still kept on the child interfaces when
     # you bond.  By skipping bond we avoid double counting.
-        f_netdev = open("/proc/net/dev", "r")
-        f_netdev.seek(0)
-        ts = int(time.time())
-        for line in f_netdev:
-            m = re.match("\s*(?P<iface_name>(vlan|eth)\d+):(?P<data>.*)", line)
-            if not m:
-                continue
-            stats = m.group('data').split(None)
-            for i in range(8):
-                if FIELDS[i]:
-                    print ("proc.net.%s %d %s iface=%s direction=in"
-                           % (FIELDS[i], ts, stats[i], m.group('iface_name')))
-                    print ("proc.net.%s %d %s iface=%s direction=out"
-                           % (FIELDS[i], ts, stats[i+8], m.group('iface_name')))
-
-        sys.stdout.flush()
+    ts = int(time.time())
+    for iface_name, stats in procfs.net_dev():
+        if not IFACE_RE.match(iface_name):
+            continue
+        iface = "iface=" + iface_name
+        for i in range(8):
+            if FIELDS[i]:
+                yield ("proc.net." + FIELDS[i], ts, stats[i],
+                       iface + " direction=in")
+                yield ("proc.net." + FIELDS[i], ts, stats[i+8],
+                       iface + " direction=out")
+
+
+def main():
+    for metric, ts, value, tags in collect():
+        print "%s %d %s %s" % (metric, ts, value, tags)
+
+    sys.stdout.flush()
 
 if __name__ == "__main__":
     main()
-
@@ -57,22 +57,32 @@
 # partition series.  To fix this, we output by-disk data to iostat.disk.*
 # and by-partition data to iostat.part.*.
 
-# TODO: Add additional tags to map partitions/disks back to mount
-# points/swap so you can (for example) plot just swap partition
-# activity or /var/lib/mysql partition activity no matter which
-# disk/partition this happens to be.  This is nontrivial, especially
-# when you have to handle mapping of /dev/mapper to dm-N, pulling out
-# swap partitions from /proc/swaps, etc.
+# Devices mounted somewhere get a mount= tag (mount=swap for swap
+# partitions) and device-mapper devices a dm_name= tag, so you can (for
+# example) plot just swap partition activity or /var/lib/mysql partition
+# activity no matter which disk/partition this happens to be.  Mounts
+# come from /proc/self/mountinfo and swap from /proc/swaps, both matched
+# by device number, and dm names from /sys/block/dm-N/dm/name.  The map
+# is kept while the check runs in-process and built again only when the
+# kernel flags a change of the mount table or of swap.
 
 # TODO: add some generated stats from iostat -x like svctm, await,
 # %util.  These need to pull in cpu idle counters from /proc.
 
 
+import errno
 import os
-import socket
+import select
 import sys
 import time
 
+import procfs
+from tags import tag_value
+
+MOUNTINFO = "/proc/self/mountinfo"
+SWAPS = "/proc/swaps"
+DM_NAME = "/sys/block/%s/dm/name"
+
 # Docs come from the Linux kernel's Documentation/iostats.txt
 FIELDS_DISK = (
     "read_requests",        # Total number of reads completed successfully.
@@ -95,48 +105,156 @@ FIELDS_PART = ("read_issued",
               )
 
 
+class Watched(object):
+    """A /proc file that flags changes to poll() with POLLPRI, like
+    mountinfo and swaps."""
+
+    def __init__(self, path):
+        self.file = open(path)
+        self.poller = select.poll()
+        self.poller.register(self.file, select.POLLPRI | select.POLLERR)
+
+    def changed(self):
+        return bool(self.poller.poll(0))
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+
+def open_watched(path):
+    try:
+        return Watched(path)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+class DeviceMap(object):
+    """The extra tags of block devices."""
+
+    def __init__(self):
+        self.mountinfo = open_watched(MOUNTINFO)
+        self.swaps = open_watched(SWAPS)
+        # (major, minor) -> " mount=..."
+        self.mounts = None
+        # dm-N -> " dm_name=..."
+        self.dm_names = {}
+
+    def changed(self):
+        # poll() both, each only reports a change once
+        changed = self.mounts is None
+        for source in (self.mountinfo, self.swaps):
+            if source and source.changed():
+                changed = True
+        return changed
+
+    def tags(self, major, minor, name):
+        if self.changed():
+            self.mounts = self.read_mounts()
+            self.dm_names = {}
+        tags = self.mounts.get((major, minor), "")
+        if name.startswith("dm-"):
+            dm_name = self.dm_names.get(name)
+            if dm_name is None:
+                dm_name = self.dm_names[name] = self.read_dm_name(name)
+            tags += dm_name
+        return tags
+
+    def read_mounts(self):
+        mounts = {}
+        if self.mountinfo:
+            for line in self.mountinfo.read().splitlines():
+                fields = line.split()
+                if len(fields) < 5:
+                    continue
+                major, _, minor = fields[2].partition(":")
+                try:
+                    dev = int(major), int(minor)
+                except ValueError:
+                    continue
+                path = fields[4].decode("string_escape")
+                # the shortest path of a device mounted more than once
+                if dev not in mounts or len(path) < len(mounts[dev]):
+                    mounts[dev] = path
+        if self.swaps:
+            for line in self.swaps.read().splitlines()[1:]:
+                fields = line.split()
+                if len(fields) < 2 or fields[1] != "partition":
+                    continue
+                try:
+                    rdev = os.stat(fields[0].decode("string_escape")).st_rdev
+                except OSError:
+                    continue
+                mounts[os.major(rdev), os.minor(rdev)] = "swap"
+        return dict((dev, " mount=" + tag_value(path))
+                    for dev, path in mounts.iteritems())
+
+    def read_dm_name(self, name):
+        try:
+            f = open(DM_NAME % name)
+            try:
+                dm_name = f.read().strip()
+            finally:
+                f.close()
+        except IOError:
+            return ""
+        if not dm_name:
+            return ""
+        return " dm_name=" + tag_value(dm_name)
+
+
+# kept while in-process, see above
+device_map = None
+
+
+def collect(confs_dir=None):
+    """Yields (metric, timestamp, value, tags) for /proc/diskstats."""
+    global device_map
+    if device_map is None:
+        device_map = DeviceMap()
+    ts = int(time.time())
+    for values in procfs.diskstats():
+        # maj, min, devicename, [list of stats, see above]
+        # shortcut the deduper and just skip disks that
+        # haven't done a single read.  This elimiates a bunch
+        # of loopback, ramdisk, and cdrom devices but still
+        # lets us report on the rare case that we actually use
+        # a ramdisk.
+        if values[3] == "0":
+            continue
+
+        if int(values[1]) % 16 == 0 and int(values[0]) > 1:
+            metric = "iostat.disk."
+        else:
+            metric = "iostat.part."
+
+        # Sometimes there can be a slash in the device name, see bug #8.
+        # TODO(tsuna): Remove the substitution once TSD allows `/' in tags.
+        device = "dev=" + values[2].replace("/", "_")
+        device += device_map.tags(int(values[0]), int(values[1]),
+                                  values[2])
+        if len(values) >= 14:
+            # full stats line, newer kernels add discard and flush
+            # stats after these
+            for i in range(11):
+                yield metric + FIELDS_DISK[i], ts, values[i+3], device
+        elif len(values) == 7:
+            # partial stats line
+            for i in range(4):
+                yield metric + FIELDS_PART[i], ts, values[i+3], device
+        else:
+            print >> sys.stderr, "Cannot parse /proc/diskstats line: ", values
+            continue
+
+
 def main():
-        f_diskstats = open("/proc/diskstats", "r")
-        f_diskstats.seek(0)
-        ts = int(time.time())
-        for line in f_diskstats:
-            # maj, min, devicename, [list of stats, see above]
-            values = line.split(None)
-            # shortcut the deduper and just skip disks that
-            # haven't done a single read.  This elimiates a bunch
-            # of loopback, ramdisk, and cdrom devices but still
-            # lets us report on the rare case that we actually use
-            # a ramdisk.
-            if values[3] == "0":
-                continue
-
-            if int(values[1]) % 16 == 0 and int(values[0]) > 1:
-                metric = "iostat.disk."
-            else:
-                metric = "iostat.part."
-
-            # Sometimes there can be a slash in the device name, see bug #8.
-            # TODO(tsuna): Remove the substitution once TSD allows `/' in tags.
-            device = values[2].replace("/", "_")
-            if len(values) == 14:
-                # full stats line
-                for i in range(11):
-                    print ("%s%s %d %s dev=%s"
-                           % (metric, FIELDS_DISK[i], ts, values[i+3],
-                              device))
-            elif len(values) == 7:
-                # partial stats line
-                for i in range(4):
-                    print ("%s%s %d %s dev=%s"
-                           % (metric, FIELDS_PART[i], ts, values[i+3],
-                              device))
-            else:
-                print >> sys.stderr, "Cannot parse /proc/diskstats line: ", line
-                continue
-
-        sys.stdout.flush()
+    for metric, ts, value, tags in collect():
+        print "%s %d %s %s" % (metric, ts, value, tags)
+
+    sys.stdout.flush()
 
 
 if __name__ == "__main__":
     main()
-
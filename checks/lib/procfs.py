@@ -0,0 +1,174 @@
+"""Reads and parses the /proc files of the checks, shared between them.
+
+The collector puts this directory on the path of the checks, which import
+procfs. As the checks run in-process import the same module, what it keeps
+lives as long as the collector:
+
+  - every file stays open and is read again from the start into a buffer
+    kept for it, until a read returns nothing; many /proc files return
+    about a page of whole records per read, so big ones take several, and
+    the buffer doubles when the file outgrows it;
+  - a snapshot of a file younger than MAX_AGE seconds is served as is, and
+    so is what a parser made of it, so the checks of one run that want
+    /proc/stat or /proc/net/dev share one read and one parse.
+
+The parsers run precompiled regular expressions over the whole file. What
+they return is shared: don't change it. In-process checks run one at a
+time, so none of this is locked.
+"""
+import io
+import re
+import time
+
+# seconds a snapshot is served to the checks of the same run
+MAX_AGE = 1.0
+BUFSIZE = 16384
+
+STAT_LINE = re.compile(r'^(\w+)\s+(.*)$', re.M).findall
+# as procstats always did, "Active(anon):" and the like are left out
+MEMINFO_LINE = re.compile(r'^(\w+):\s+(\d+)', re.M).findall
+VMSTAT_LINE = re.compile(r'^(\w+)\s+(\d+)', re.M).findall
+NET_DEV_LINE = re.compile(r'^\s*([^\s:]+):(.*)$', re.M).findall
+SECTION_LINE = re.compile(r'^(\w+):(.*)\n^\1:(.*)$', re.M).findall
+
+
+class ProcFile(object):
+    """A /proc file kept open, with its last snapshot and what the parsers
+    made of it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = io.FileIO(path, 'r')
+        self.buffer = bytearray(BUFSIZE)
+        self.data = None
+        self.time = 0
+        self.parsed = {}
+
+    def read(self):
+        self.file.seek(0)
+        size = 0
+        while True:
+            if size == len(self.buffer):
+                grown = bytearray(2 * len(self.buffer))
+                grown[:size] = self.buffer
+                self.buffer = grown
+            count = self.file.readinto(memoryview(self.buffer)[size:])
+            if not count:
+                break
+            size += count
+        self.data = memoryview(self.buffer)[:size].tobytes()
+        self.time = time.time()
+        self.parsed = {}
+        return self.data
+
+    def snapshot(self, max_age):
+        if self.data is None or time.time() - self.time >= max_age:
+            return self.read()
+        return self.data
+
+    def close(self):
+        self.file.close()
+
+
+# by path
+files = {}
+
+
+def get(path):
+    procfile = files.get(path)
+    if procfile is None:
+        procfile = files[path] = ProcFile(path)
+    return procfile
+
+
+def snapshot(path, max_age):
+    procfile = get(path)
+    try:
+        return procfile, procfile.snapshot(max_age)
+    except IOError:
+        # e.g. ENODEV once a device or NUMA node is gone: open it again
+        # next time rather than keep reading a dead file
+        procfile.close()
+        del files[path]
+        raise
+
+
+def read(path, max_age=MAX_AGE):
+    """Returns the contents of path, read at most max_age seconds ago.
+    Raises IOError if it can't be opened or read."""
+    return snapshot(path, max_age)[1]
+
+
+def parse(path, parser, max_age=MAX_AGE):
+    """Returns parser(contents of path), parsed once per snapshot."""
+    procfile, data = snapshot(path, max_age)
+    result = procfile.parsed.get(parser)
+    if result is None:
+        result = procfile.parsed[parser] = parser(data)
+    return result
+
+
+def close():
+    """Closes all the files, e.g. in a check that forks."""
+    for procfile in files.itervalues():
+        procfile.close()
+    files.clear()
+
+
+def parse_stat(data):
+    """{"cpu": "user nice system ...", "intr": "total ...", "ctxt": "..."}:
+    the rest of each line, unsplit as intr can be thousands of numbers."""
+    return dict(STAT_LINE(data))
+
+
+def parse_pairs(data):
+    """[(name, value), ...] in file order, for meminfo."""
+    return MEMINFO_LINE(data)
+
+
+def parse_vmstat(data):
+    return VMSTAT_LINE(data)
+
+
+def parse_diskstats(data):
+    """[[major, minor, device, stat, ...], ...]"""
+    return [line.split() for line in data.splitlines()]
+
+
+def parse_net_dev(data):
+    """[(interface, [16 receive and transmit stats]), ...]"""
+    return [(iface, stats.split()) for iface, stats in NET_DEV_LINE(data)]
+
+
+def parse_sections(data):
+    """[(section, [(name, value), ...]), ...] for the two lines per section
+    format of /proc/net/netstat and /proc/net/snmp:
+        TcpExt: SyncookiesSent SyncookiesRecv ...
+        TcpExt: 0 0 ...
+    """
+    return [(section, zip(names.split(), values.split()))
+            for section, names, values in SECTION_LINE(data)]
+
+
+def stat(max_age=MAX_AGE):
+    return parse("/proc/stat", parse_stat, max_age)
+
+
+def meminfo(max_age=MAX_AGE):
+    return parse("/proc/meminfo", parse_pairs, max_age)
+
+
+def vmstat(max_age=MAX_AGE):
+    return parse("/proc/vmstat", parse_vmstat, max_age)
+
+
+def diskstats(max_age=MAX_AGE):
+    return parse("/proc/diskstats", parse_diskstats, max_age)
+
+
+def net_dev(max_age=MAX_AGE):
+    return parse("/proc/net/dev", parse_net_dev, max_age)
+
+
+def net_netstat(max_age=MAX_AGE):
+    return parse("/proc/net/netstat", parse_sections, max_age)
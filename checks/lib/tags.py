@@ -0,0 +1,15 @@
+"""Helpers for the tags the checks put on their metrics, shared between them.
+
+The collector puts this directory on the path of the checks, which
+import tags.
+"""
+import re
+
+# characters a tag value can't have
+NOT_TAG = re.compile(r'[^-a-zA-Z0-9_./]')
+
+
+def tag_value(value):
+    """value with what the TSD would refuse in a tag value replaced by _,
+    e.g. the spaces or colons of a mount point."""
+    return NOT_TAG.sub("_", value)
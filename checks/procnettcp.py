@@ -14,8 +14,8 @@
 
 """TCP socket state data for TSDB"""
 #
-# Read /proc/net/tcp, which gives netstat -a type
-# data for all TCP sockets.
+# Ask the kernel through NETLINK_SOCK_DIAG, or read /proc/net/tcp, which
+# gives netstat -a type data for all TCP sockets.
 
 # Note this collector generates a lot of lines, given that there are
 #  lots of tcp states and given the number of subcollections we do.
@@ -48,12 +48,23 @@
 # opened/handled the connection.  For connections in time_wait, for
 # example, they will always show user=root.
 
+# With hundreds of thousands of sockets, parsing /proc/net/tcp as text is
+# expensive.  The netlink backend gets the same data from the kernel in
+# binary form, only for the states below, and falls back to /proc where
+# sock_diag isn't available.  Set BACKEND to "proc" to always use /proc.
+
 import os
 import sys
 import time
 import socket
+import struct
 import pwd
 
+import procfs
+
+
+BACKEND = "netlink"
+
 
 USERS = ("root", "www-data")
 
@@ -86,9 +97,30 @@ TCPSTATES = {
     "0B": "closing",
     }
 
+STATES = dict((int(state, 16), name) for state, name in TCPSTATES.iteritems())
+
 # If we're running as root and this user exists, we'll drop privileges.
 USER = "nobody"
 
+# see linux/netlink.h, linux/sock_diag.h and linux/inet_diag.h
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+TCP_NEW_SYN_RECV = 12
+NLMSG_HEADER = struct.Struct("=IHHII")
+# inet_diag_req_v2, with a zeroed socket id to dump all sockets
+INET_DIAG_REQ = struct.Struct("=BBBxI48x")
+# inet_diag_msg: family, state, (timer, retrans), source and destination
+# port and address in network byte order, (interface, cookie, expires,
+# receive and send queue), uid, (inode)
+INET_DIAG_MSG = struct.Struct("=xBxx2s2s16s16s24xI4x")
+RECV_BUF = 64 * 1024
+# seconds to wait for the kernel
+TIMEOUT = 10
+
 
 def drop_privileges():
     try:
@@ -113,8 +145,15 @@ def is_public_ip(ipstr):
     """
     addr = ipstr.split(":")[0]
     addr = int(addr, 16)
-    byte1 = addr & 0xFF
-    byte2 = (addr >> 8) & 0xFF
+    return is_public(addr & 0xFF, (addr >> 8) & 0xFF)
+
+
+def is_public_addr(addr):
+    """Same as is_public_ip for an address in network byte order."""
+    return is_public(ord(addr[0]), ord(addr[1]))
+
+
+def is_public(byte1, byte2):
     if byte1 in (10, 0, 127):
         return False
     if byte1 == 172 and byte2 > 16:
@@ -124,46 +163,110 @@ def is_public_ip(ipstr):
     return True
 
 
-def main(unused_args):
-    """procnettcp main loop"""
-    drop_privileges()
-    try:           # On some Linux kernel versions, with lots of connections
-      os.nice(19)  # this collector can be very CPU intensive.  So be nicer.
-    except OSError, e:
-      print >>sys.stderr, "warning: failed to self-renice:", e
-
-    # resolve the list of users to match on into UIDs
-    uids = {}
-    for user in USERS:
+def count_key(counter, state, endpoint, service, user):
+    key = (state, endpoint, service, user)
+    if key in counter:
+        counter[key] += 1
+    else:
+        counter[key] = 1
+
+
+def open_dump(family):
+    """Returns a netlink socket which a sock_diag dump of the TCP sockets of
+    family in the states we report was requested on."""
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                         NETLINK_SOCK_DIAG)
+    states = 0
+    for state in STATES:
+        states |= 1 << state
+    # half open connections, which are reported as syn_recv
+    states |= 1 << TCP_NEW_SYN_RECV
+    request = INET_DIAG_REQ.pack(family, socket.IPPROTO_TCP, 0, states)
+    try:
+        sock.settimeout(TIMEOUT)
+        sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(request),
+                                    SOCK_DIAG_BY_FAMILY,
+                                    NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+                  + request)
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+def count_netlink(counter, uids):
+    """Counts the sockets through NETLINK_SOCK_DIAG, raises socket.error
+    when that doesn't work here."""
+    header = NLMSG_HEADER
+    header_size = header.size
+    message = INET_DIAG_MSG
+    # ports as they come, in network byte order
+    ports = dict((struct.pack("!H", port), service)
+                 for port, service in PORTS.iteritems())
+    # endpoint by the first two bytes of both addresses
+    endpoints = {}
+    for family in (socket.AF_INET, socket.AF_INET6):
+        sock = open_dump(family)
         try:
-            uids[str(pwd.getpwnam(user)[2])] = user
-        except KeyError:
-            continue
-
+            done = False
+            while not done:
+                data = sock.recv(RECV_BUF)
+                if not data:
+                    break
+                offset = 0
+                while offset < len(data):
+                    length, kind = header.unpack_from(data, offset)[:2]
+                    if kind == NLMSG_DONE:
+                        done = True
+                        break
+                    if kind == NLMSG_ERROR:
+                        error = -struct.unpack_from("=i", data,
+                                                    offset + header_size)[0]
+                        raise socket.error(error, os.strerror(error))
+                    if kind == SOCK_DIAG_BY_FAMILY:
+                        (state, sport, dport, src, dst,
+                         uid) = message.unpack_from(data, offset + header_size)
+                        service = ports.get(sport, "other")
+                        service = ports.get(dport, service)
+                        prefixes = src[:2] + dst[:2]
+                        endpoint = endpoints.get(prefixes)
+                        if endpoint is None:
+                            if is_public_addr(dst) or is_public_addr(src):
+                                endpoint = "external"
+                            else:
+                                endpoint = "internal"
+                            endpoints[prefixes] = endpoint
+                        state = STATES.get(state)
+                        if state:
+                            count_key(counter, state, endpoint, service,
+                                      uids.get(uid, "other"))
+                    offset += (length + 3) & ~3
+        finally:
+            sock.close()
+
+
+def count_proc(counter, uids):
+    """Counts the sockets listed in /proc/net/tcp and tcp6, returns an
+    exit code if they can't be read."""
+    uids = dict((str(uid), user) for uid, user in uids.iteritems())
     try:
-        tcp = open("/proc/net/tcp")
+        tcp = procfs.read("/proc/net/tcp")
         # if IPv6 is enabled, even IPv4 connections will also
         # appear in tcp6. It has the same format, apart from the
         # address size
         try:
-            tcp6 = open("/proc/net/tcp6")
+            tcp6 = procfs.read("/proc/net/tcp6")
         except IOError, (errno, msg):
             if errno == 2:  # No such file => IPv6 is disabled.
-                tcp6 = None
+                tcp6 = ""
             else:
                 raise
     except IOError, e:
         print >>sys.stderr, "Failed to open input file: %s" % (e,)
         return 13  # Ask tcollector to not re-start us immediately.
 
-    counter = {}
-
-    for procfile in (tcp, tcp6):
-        if procfile is None:
-            continue
-        procfile.seek(0)
-        ts = int(time.time())
-        for line in procfile:
+    for data in (tcp, tcp6):
+        for line in data.splitlines():
             try:
                 # pylint: disable=W0612
                 (num, src, dst, state, queue, when, retrans,
@@ -187,26 +290,51 @@ def main(unused_args):
                 endpoint = "internal"
 
 
-            user = uids.get(uid, "other")
+            count_key(counter, TCPSTATES[state], endpoint, service,
+                      uids.get(uid, "other"))
 
-            key = "state=" + TCPSTATES[state] + " endpoint=" + endpoint + \
-                  " service=" + service + " user=" + user
-            if key in counter:
-                counter[key] += 1
-            else:
-                counter[key] = 1
+
+def main(unused_args):
+    """procnettcp main loop"""
+    drop_privileges()
+    try:           # On some Linux kernel versions, with lots of connections
+      os.nice(19)  # this collector can be very CPU intensive.  So be nicer.
+    except OSError, e:
+      print >>sys.stderr, "warning: failed to self-renice:", e
+
+    # resolve the list of users to match on into UIDs
+    uids = {}
+    for user in USERS:
+        try:
+            uids[pwd.getpwnam(user)[2]] = user
+        except KeyError:
+            continue
+
+    counter = {}
+    ts = int(time.time())
+    done = False
+    if BACKEND == "netlink":
+        try:
+            count_netlink(counter, uids)
+            done = True
+        except (socket.error, AttributeError), e:
+            # AttributeError: no AF_NETLINK, i.e. not Linux
+            print >>sys.stderr, "sock_diag failed, reading /proc:", e
+            counter = {}
+    if not done:
+        code = count_proc(counter, uids)
+        if code:
+            return code
 
     # output the counters
-    for state in TCPSTATES:
+    for state in TCPSTATES.itervalues():
         for service in SERVICES + ("other",):
             for user in USERS + ("other",):
                 for endpoint in ("internal", "external"):
                     key = ("state=%s endpoint=%s service=%s user=%s"
-                           % (TCPSTATES[state], endpoint, service, user))
-                    if key in counter:
-                        print "proc.net.tcp", ts, counter[key], key
-                    else:
-                        print "proc.net.tcp", ts, "0", key
+                           % (state, endpoint, service, user))
+                    print "proc.net.tcp", ts, counter.get(
+                        (state, endpoint, service, user), 0), key
 
     sys.stdout.flush()
 
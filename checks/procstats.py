@@ -20,11 +20,15 @@ import time
 import socket
 import re
 
+import procfs
+
 NUMADIR = "/sys/devices/system/node"
+LOADAVG_RE = re.compile("(\S+)\s+(\S+)\s+(\S+)\s+(\d+)/(\d+)\s+")
+VMSTATS = ("pgpgin", "pgpgout", "pswpin", "pswpout", "pgfault", "pgmajfault")
 
 
-def open_sysfs_numa_stats():
-    """Returns a possibly empty list of opened files."""
+def sysfs_numa_stats():
+    """Returns a possibly empty list of numastat files."""
     try:
         nodes = os.listdir(NUMADIR)
     except OSError, (errno, msg):
@@ -32,145 +36,114 @@ def open_sysfs_numa_stats():
             return []   # We don't have NUMA stats.
         raise
 
-    nodes = [node for node in nodes if node.startswith("node")]
-    numastats = []
-    for node in nodes:
-        try:
-            numastats.append(open(os.path.join(NUMADIR, node, "numastat")))
-        except OSError, (errno, msg):
-            if errno == 2:  # No such file or directory
-                continue
-            raise
-    return numastats
+    return [os.path.join(NUMADIR, node, "numastat") for node in nodes
+            if node.startswith("node")]
 
 
-def print_numa_stats(numafiles):
-    """From a list of opened files, extracts and prints NUMA stats."""
+def numa_stats(numafiles):
+    """From a list of numastat files, extracts NUMA stats."""
     for numafile in numafiles:
-        numafile.seek(0)
-        node_id = int(numafile.name[numafile.name.find("/node/node")+10:-9])
+        try:
+            data = procfs.read(numafile)
+        except IOError, (errno, msg):
+            # ENOENT or ENODEV, the node was removed or taken offline
+            if errno in (2, 19):
+                continue
+            raise
+        node_id = int(numafile[numafile.find("/node/node")+10:-9])
         ts = int(time.time())
-        stats = dict(line.split() for line in numafile.read().splitlines())
+        stats = dict(line.split() for line in data.splitlines())
         for stat, tag in (# hit: process wanted memory from this node and got it
                           ("numa_hit", "hit"),
                           # miss: process wanted another node and got it from
                           # this one instead.
                           ("numa_miss", "miss")):
-            print ("sys.numa.zoneallocs %d %s node=%d type=%s"
-                   % (ts, stats[stat], node_id, tag))
+            yield ("sys.numa.zoneallocs", ts, stats[stat],
+                   "node=%d type=%s" % (node_id, tag))
         # Count this one as a separate metric because we can't sum up hit +
         # miss + foreign, this would result in double-counting of all misses.
         # See `zone_statistics' in the code of the kernel.
         # foreign: process wanted memory from this node but got it from
         # another node.  So maybe this node is out of free pages.
-        print ("sys.numa.foreign_allocs %d %s node=%d"
-               % (ts, stats["numa_foreign"], node_id))
+        yield ("sys.numa.foreign_allocs", ts, stats["numa_foreign"],
+               "node=%d" % node_id)
         # When is memory allocated to a node that's local or remote to where
         # the process is running.
         for stat, tag in (("local_node", "local"),
                           ("other_node", "remote")):
-            print ("sys.numa.allocation %d %s node=%d type=%s"
-                   % (ts, stats[stat], node_id, tag))
+            yield ("sys.numa.allocation", ts, stats[stat],
+                   "node=%d type=%s" % (node_id, tag))
         # Pages successfully allocated with the interleave policy.
-        print ("sys.numa.interleave %d %s node=%d type=hit"
-               % (ts, stats["interleave_hit"], node_id))
+        yield ("sys.numa.interleave", ts, stats["interleave_hit"],
+               "node=%d type=hit" % node_id)
 
 
-def main():
-    """procstats main loop"""
+CPU_TYPES = ("user", "nice", "system", "idle", "iowait", "irq", "softirq",
+             # really old kernels don't have this field
+             "guest",
+             # old kernels don't have this field
+             "guest_nice")
 
-    f_uptime = open("/proc/uptime", "r")
-    f_meminfo = open("/proc/meminfo", "r")
-    f_vmstat = open("/proc/vmstat", "r")
-    f_stat = open("/proc/stat", "r")
-    f_loadavg = open("/proc/loadavg", "r")
-    f_entropy_avail = open("/proc/sys/kernel/random/entropy_avail", "r")
-    numastats = open_sysfs_numa_stats()
+
+def collect(confs_dir=None):
+    """Yields (metric, timestamp, value, tags) for the /proc stats."""
 
     # proc.uptime
-    f_uptime.seek(0)
     ts = int(time.time())
-    for line in f_uptime:
-        m = re.match("(\S+)\s+(\S+)", line)
-        if m:
-            print "proc.uptime.total %d %s" % (ts, m.group(1))
-            print "proc.uptime.now %d %s" % (ts, m.group(2))
+    uptime = procfs.read("/proc/uptime").split()
+    if len(uptime) >= 2:
+        yield "proc.uptime.total", ts, uptime[0], ""
+        yield "proc.uptime.now", ts, uptime[1], ""
 
     # proc.meminfo
-    f_meminfo.seek(0)
     ts = int(time.time())
-    for line in f_meminfo:
-        m = re.match("(\w+):\s+(\d+)", line)
-        if m:
-            print ("proc.meminfo.%s %d %s"
-                    % (m.group(1).lower(), ts, m.group(2)))
+    for name, value in procfs.meminfo():
+        yield "proc.meminfo." + name.lower(), ts, value, ""
 
     # proc.vmstat
-    f_vmstat.seek(0)
     ts = int(time.time())
-    for line in f_vmstat:
-        m = re.match("(\w+)\s+(\d+)", line)
-        if not m:
-            continue
-        if m.group(1) in ("pgpgin", "pgpgout", "pswpin",
-                          "pswpout", "pgfault", "pgmajfault"):
-            print "proc.vmstat.%s %d %s" % (m.group(1), ts, m.group(2))
+    for name, value in procfs.vmstat():
+        if name in VMSTATS:
+            yield "proc.vmstat." + name, ts, value, ""
 
     # proc.stat
-    f_stat.seek(0)
     ts = int(time.time())
-    for line in f_stat:
-        m = re.match("(\w+)\s+(.*)", line)
-        if not m:
-            continue
-        if m.group(1) == "cpu":
-            fields = m.group(2).split()
-            print "proc.stat.cpu %d %s type=user" % (ts, fields[0])
-            print "proc.stat.cpu %d %s type=nice" % (ts, fields[1])
-            print "proc.stat.cpu %d %s type=system" % (ts, fields[2])
-            print "proc.stat.cpu %d %s type=idle" % (ts, fields[3])
-            print "proc.stat.cpu %d %s type=iowait" % (ts, fields[4])
-            print "proc.stat.cpu %d %s type=irq" % (ts, fields[5])
-            print "proc.stat.cpu %d %s type=softirq" % (ts, fields[6])
-            # really old kernels don't have this field
-            if len(fields) > 7:
-                print ("proc.stat.cpu %d %s type=guest"
-                       % (ts, fields[7]))
-                # old kernels don't have this field
-                if len(fields) > 8:
-                    print ("proc.stat.cpu %d %s type=guest_nice"
-                           % (ts, fields[8]))
-        elif m.group(1) == "intr":
-            print ("proc.stat.intr %d %s"
-                    % (ts, m.group(2).split()[0]))
-        elif m.group(1) == "ctxt":
-            print "proc.stat.ctxt %d %s" % (ts, m.group(2))
-        elif m.group(1) == "processes":
-            print "proc.stat.processes %d %s" % (ts, m.group(2))
-        elif m.group(1) == "procs_blocked":
-            print "proc.stat.procs_blocked %d %s" % (ts, m.group(2))
-
-    f_loadavg.seek(0)
+    stat = procfs.stat()
+    if "cpu" in stat:
+        for cpu_type, value in zip(CPU_TYPES, stat["cpu"].split()):
+            yield "proc.stat.cpu", ts, value, "type=" + cpu_type
+    if "intr" in stat:
+        yield "proc.stat.intr", ts, stat["intr"].split(None, 1)[0], ""
+    for name in ("ctxt", "processes", "procs_blocked"):
+        if name in stat:
+            yield "proc.stat." + name, ts, stat[name], ""
+
     ts = int(time.time())
-    for line in f_loadavg:
-        m = re.match("(\S+)\s+(\S+)\s+(\S+)\s+(\d+)/(\d+)\s+", line)
-        if not m:
-            continue
-        print "proc.loadavg.1min %d %s" % (ts, m.group(1))
-        print "proc.loadavg.5min %d %s" % (ts, m.group(2))
-        print "proc.loadavg.15min %d %s" % (ts, m.group(3))
-        print "proc.loadavg.runnable %d %s" % (ts, m.group(4))
-        print "proc.loadavg.total_threads %d %s" % (ts, m.group(5))
-
-    f_entropy_avail.seek(0)
+    m = LOADAVG_RE.match(procfs.read("/proc/loadavg"))
+    if m:
+        yield "proc.loadavg.1min", ts, m.group(1), ""
+        yield "proc.loadavg.5min", ts, m.group(2), ""
+        yield "proc.loadavg.15min", ts, m.group(3), ""
+        yield "proc.loadavg.runnable", ts, m.group(4), ""
+        yield "proc.loadavg.total_threads", ts, m.group(5), ""
+
     ts = int(time.time())
-    for line in f_entropy_avail:
-        print "proc.kernel.entropy_avail %d %s" % (ts, line.strip())
+    yield ("proc.kernel.entropy_avail", ts,
+           procfs.read("/proc/sys/kernel/random/entropy_avail").strip(), "")
+
+    for datapoint in numa_stats(sysfs_numa_stats()):
+        yield datapoint
 
-    print_numa_stats(numastats)
+
+def main():
+    """procstats main loop"""
+    for metric, ts, value, tags in collect():
+        if tags:
+            print "%s %d %s %s" % (metric, ts, value, tags)
+        else:
+            print "%s %d %s" % (metric, ts, value)
 
     sys.stdout.flush()
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,141 @@
+"""Rolls up the series of a check before its output is spooled.
+
+Rules are the options of the Aggregation section, for example
+
+    [Aggregation]
+    tcp = proc.net.tcp sum by state
+    partitions = iostat.part.* sum by
+    gc = jvm.memory.gc.* sum by type keep
+
+The value is a metric pattern (fnmatch style), one of sum, min, max or count,
+then "by" and the comma separated tags to group on; any other tag of the
+check is aggregated away. Datapoints are only combined with the ones of the
+same check run and timestamp. The rollup replaces the raw series, unless the
+rule ends with "keep": then both are written and the rollup is named
+<metric>.<function>, so queries on the raw metric don't count it twice.
+Only one rule without "keep" should match a metric, as their rollups would
+end up in the same series.
+"""
+import fnmatch
+import logging
+import re
+
+import opentsdb_datapoint
+
+LOG = logging.getLogger('opentsdb_checks.aggregate')
+
+FUNCTIONS = {
+    "sum": lambda total, value: total + value,
+    "min": min,
+    "max": max,
+    "count": lambda total, value: total + 1,
+}
+KEEP = "keep"
+BY = "by"
+
+
+def parse_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def format_number(value):
+    if isinstance(value, float):
+        # str() rounds to 12 digits, too few for big counters
+        return repr(value)
+    return str(value)
+
+
+class Rule(object):
+
+    def __init__(self, name, value):
+        tokens = value.split()
+        if len(tokens) < 2 or tokens[1] not in FUNCTIONS:
+            raise ValueError("expected a pattern and one of %s"
+                             % ", ".join(sorted(FUNCTIONS)))
+        self.name = name
+        self.match = re.compile(fnmatch.translate(tokens[0])).match
+        self.function = tokens[1]
+        self.combine = FUNCTIONS[self.function]
+        tokens = tokens[2:]
+        self.keep = bool(tokens) and tokens[-1] == KEEP
+        if self.keep:
+            tokens.pop()
+        if tokens and tokens[0] == BY:
+            tokens.pop(0)
+        if len(tokens) > 1:
+            raise ValueError("unexpected %r" % " ".join(tokens[1:]))
+        self.by = tokens and [tag for tag in tokens[0].split(",") if tag] or []
+
+    def metric(self, metric):
+        if self.keep:
+            return metric + "." + self.function
+        return metric
+
+    def first(self, value):
+        if self.function == "count":
+            return 1
+        return value
+
+
+class Rules(object):
+    """The rules of the Aggregation section, with the ones matching each
+    metric looked up only once."""
+
+    def __init__(self, items):
+        self.rules = []
+        for name, value in items:
+            try:
+                self.rules.append(Rule(name, value))
+            except ValueError, e:
+                LOG.error("Bad aggregation rule %s = %s: %s" % (name, value, e))
+        self.matches = {}
+
+    def __len__(self):
+        return len(self.rules)
+
+    def matching(self, metric):
+        rules = self.matches.get(metric)
+        if rules is None:
+            rules = self.matches[metric] = [rule for rule in self.rules
+                                            if rule.match(metric)]
+        return rules
+
+
+class Aggregator(object):
+    """Collects the rollups of one check run."""
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.groups = {}
+
+    def add(self, point):
+        """Adds a Datapoint to the rollups it belongs to, returns whether
+        the point itself is to be written too."""
+        rules = self.rules.matching(point.metric)
+        if not rules:
+            return True
+        value = parse_number(point.value)
+        tags = dict(tag.split("=", 1) for tag in point.tags.split())
+        keep = True
+        for rule in rules:
+            key = (rule, rule.metric(point.metric), point.ts,
+                   " ".join("%s=%s" % (tag, tags[tag])
+                            for tag in rule.by if tag in tags))
+            total = self.groups.get(key)
+            if total is None:
+                self.groups[key] = rule.first(value)
+            else:
+                self.groups[key] = rule.combine(total, value)
+            keep = keep and rule.keep
+        return keep
+
+    def points(self):
+        """Returns the rollups as Datapoints and starts over."""
+        points = [opentsdb_datapoint.Datapoint(metric, ts, format_number(total),
+                                               tags)
+                  for (rule, metric, ts, tags), total in self.groups.iteritems()]
+        self.groups = {}
+        return points
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 from logging.handlers import SysLogHandler
 from optparse import OptionParser
-import StringIO
-import re
-from string import rfind
 import ConfigParser
+import errno
+import httplib
+import imp
 import os
 import random
+import re
+import select
 import socket
 import stat
 from subprocess import PIPE
@@ -15,29 +17,96 @@ import sys
 import logging
 import time
 import signal
+import threading
+from collections import deque
 from itertools import ifilter
-import itertools
+
+import opentsdb_aggregate
+import opentsdb_datapoint
+import opentsdb_dedup
+import opentsdb_drain
+import opentsdb_http
+import opentsdb_profile
+import opentsdb_spool
+import opentsdb_stats
 
 
 READ_LINE_BUF = 1024
-WRITE_BUF = 2 * 1024 * 1024
+# lines of an in-process check handed to the ChunkWriter at once
+PLUGIN_BATCH = 1024
+READ_BUF = 64 * 1024
+SEND_BUF = 64 * 1024
+# seconds between looks at checks that closed their output but run on
+REAP_INTERVAL = 0.1
+# seconds a daemon sends for at least, even when a check is due sooner
+MIN_SEND_TIME = 1
 
 MAIN_SECTION = "Main"
 TIMEOUT_KEY = "timeout"
 RETENTION_KEY = "retention"
 MAX_CHUNKS_KEY = "max_chunks"
+MAX_SPOOL_BYTES_KEY = "max_spool_bytes"
 CHECKSDIR_KEY = "checksdir"
 CACHEDIR_KEY = "cachedir"
 CONFIGDIR_KEY = "configdir"
 HOSTS_KEY = "hosts"
+INTERVAL_KEY = "interval"
+SEND_INTERVAL_KEY = "send_interval"
+INPROCESS_KEY = "inprocess"
+MAX_RUNNING_KEY = "max_running"
+MAX_OUTPUT_KEY = "max_output"
+SEGMENT_SIZE_KEY = "segment_size"
+SEGMENT_AGE_KEY = "segment_age"
+COMPRESS_LEVEL_KEY = "compress_level"
+SPOOL_FORMAT_KEY = "spool_format"
+SEND_CONNECTIONS_KEY = "send_connections"
+TRANSPORT_KEY = "transport"
+HTTP_BATCH_KEY = "http_batch"
+HTTP_COMPRESS_LEVEL_KEY = "http_compress_level"
+DEDUP_INTERVAL_KEY = "dedup_interval"
+DRAIN_BYTES_KEY = "drain_bytes"
+DRAIN_POINTS_KEY = "drain_points"
+SELF_METRICS_KEY = "self_metrics"
+MAX_TAGS_KEY = "max_tags"
+SEND_BATCH_KEY = "send_batch"
+
+TELNET_TRANSPORT = "telnet"
+HTTP_TRANSPORT = "http"
+# where checks that keep state between runs find the cache dir
+CACHE_DIR_ENV = "OPENTSDB_CHECKS_CACHE_DIR"
+# modules shared by the checks, in this directory of the checks dir, are
+# put on their path (sys.path in-process, PYTHONPATH for subprocesses)
+CHECKS_LIB = "lib"
+# errors after which a segment is handed to another connection
+SEND_ERRORS = (socket.error, httplib.HTTPException)
+
+# lines the TSD would refuse to parse: a metric, a timestamp, a number and
+# at least one tag, in the grammar of opentsdb_datapoint. Check output is
+# validated as it's spooled, this catches what older versions spooled.
+BAD_LINE = re.compile(r'^(?!%s +%s +%s(?: +%s=%s)+ *$).*\n'
+                      % (opentsdb_datapoint.NAME, opentsdb_datapoint.TIMESTAMP,
+                         opentsdb_datapoint.NUMBER, opentsdb_datapoint.NAME,
+                         opentsdb_datapoint.NAME), re.M)
+# a check defining this runs in-process, anything else is never executed
+# by the collector itself
+COLLECT_DEF = re.compile(r'^def collect\(', re.M)
+# what a TSD error message names in quotes, i.e. the offending metric or tag
+QUOTED = re.compile(r'["\']([^"\']+)["\']')
 
 TAGS_SECTION = "Tags"
+INTERVALS_SECTION = "Intervals"
+AGGREGATION_SECTION = "Aggregation"
+PRIORITIES_SECTION = "Priorities"
 
 LOG = logging.getLogger('opentsdb_checks')
 default_config = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])),
     'opentsdb_checks.defaults')
-timestamp = time.time()
 hostname = socket.gethostname()
+plugins = {}
+# what the collector reports about itself, see opentsdb_stats
+stats = opentsdb_stats.Stats()
+# set by --profile and --profile-memory, see opentsdb_profile
+profiler = None
 
 
 class Alarm(Exception):
@@ -68,10 +137,22 @@ def parse_cmdline(argv):
         action="store_true", default=False, help='Don\'t send anything, only get stats')
     parser.add_option('-t', '--send-only', dest='send_only',
         action="store_true", default=False, help='Don\'t check anything, send only')
+    parser.add_option('-D', '--daemon', dest='daemon',
+        action="store_true", default=False,
+        help='Keep running and schedule each check on its own interval')
     parser.add_option('-s', '--syslog', dest='use_syslog',
         action="store_true", default=False, help='Log to syslog.')
     parser.add_option('-v', dest='verbose', action='store_true', default=False,
         help='Verbose mode (log debug messages).')
+    parser.add_option('-p', '--profile', dest='profile',
+        action="store_true", default=False,
+        help='Write CPU profiles of every run phase and check.')
+    parser.add_option('--profile-memory', dest='profile_memory',
+        action="store_true", default=False,
+        help='Write memory reports of every run phase and check.')
+    parser.add_option('--profile-dir', dest='profile_dir', metavar='DIR',
+        default=None,
+        help='Where the profiles go (default: profile in the cache dir).')
     (options, args) = parser.parse_args(args=argv[1:])
     return options, args
 
@@ -103,6 +184,14 @@ def get_cache_dir(config):
     return config.get(MAIN_SECTION, CACHEDIR_KEY)
 
 
+def get_spool(config):
+    return opentsdb_spool.Spool(get_cache_dir(config),
+                                config.getint(MAIN_SECTION, SEGMENT_SIZE_KEY),
+                                config.getint(MAIN_SECTION, SEGMENT_AGE_KEY),
+                                config.getint(MAIN_SECTION, COMPRESS_LEVEL_KEY),
+                                config.get(MAIN_SECTION, SPOOL_FORMAT_KEY))
+
+
 def get_servers(config):
     return config.get(MAIN_SECTION, HOSTS_KEY).split(',')
 
@@ -114,6 +203,35 @@ def get_tags(config):
     return reduce(lambda accum, (key, value): accum + " " + key + "=" + value, items, "")
 
 
+def get_parser(config):
+    return opentsdb_datapoint.Parser(get_tags(config),
+                                     config.getint(MAIN_SECTION, MAX_TAGS_KEY),
+                                     READ_LINE_BUF)
+
+
+def get_aggregation_rules(config):
+    if not config.has_section(AGGREGATION_SECTION):
+        return None
+    items = [(key, value) for key, value in config.items(AGGREGATION_SECTION)
+             if not config.has_option("DEFAULT", key)]
+    return opentsdb_aggregate.Rules(items) or None
+
+
+def get_lanes(config):
+    if not config.has_section(PRIORITIES_SECTION):
+        return None
+    items = [(key, value) for key, value in config.items(PRIORITIES_SECTION)
+             if not config.has_option("DEFAULT", key)]
+    return items and opentsdb_drain.Lanes(items) or None
+
+
+def get_interval(config, check):
+    if config.has_section(INTERVALS_SECTION) \
+            and config.has_option(INTERVALS_SECTION, check):
+        return config.getint(INTERVALS_SECTION, check)
+    return config.getint(MAIN_SECTION, INTERVAL_KEY)
+
+
 def init_caches(config):
     cache_dir = get_cache_dir(config)
     LOG.debug("cache: %s" % cache_dir)
@@ -121,142 +239,754 @@ def init_caches(config):
         os.mkdir(cache_dir)
     except:
         pass
+    os.environ[CACHE_DIR_ENV] = os.path.abspath(cache_dir)
 
 
-def call_checks(run_checks, config):
+def list_checks(run_checks, config):
     checks_dir = config.get(MAIN_SECTION, CHECKSDIR_KEY)
-    confs_dir = config.get(MAIN_SECTION, CONFIGDIR_KEY)
-    timeout = config.getint(MAIN_SECTION, TIMEOUT_KEY)
-    tags = get_tags(config)
     LOG.debug("lookup for checks in: %s" % checks_dir)
-    if os.path.exists(checks_dir):
-        checks =  os.listdir(checks_dir)
-        if run_checks:
-            checks = list(ifilter(lambda f: (run_checks and f in run_checks), checks))
-        LOG.debug("run checks: %s" % checks)
-        n = 0
-        ch = {}
-        p_name = {}
-        for check in checks:
-            file = checks_dir + "/" + check
-            if not os.path.isfile(file):
-                continue
-            if not os.access(file, os.X_OK):
-                try:
-                    os.chmod(file, stat.S_IEXEC)
-                except:
-                    continue
-            n += 1
-            try:
-                ch[n] = subprocess.Popen([file, confs_dir], stdout=PIPE)
-                p_name[n] = file
-                LOG.debug("%d:check: %s" % (n, file))
-            except:
-                print "Unable to run check:", file
+    if not os.path.exists(checks_dir):
+        return []
+    checks = os.listdir(checks_dir)
+    if run_checks:
+        checks = list(ifilter(lambda f: (run_checks and f in run_checks), checks))
+    return checks
+
+
+def load_plugin(file):
+    """Imports a Python check once and returns it if it provides collect().
+
+    collect(confs_dir) must return an iterator of (metric, timestamp, value,
+    tags) tuples, tags being a possibly empty "key=value ..." string. Checks
+    without a top level "def collect(" run as a subprocess, and are not
+    executed here: importing them could start their main loop. The module
+    is imported again only when the file changes.
+    """
+    if not file.endswith(".py"):
+        return None
+    lib_dir = checks_lib(file)
+    if lib_dir not in sys.path:
+        sys.path.insert(0, lib_dir)
+    mtime = os.stat(file).st_mtime
+    cached = plugins.get(file)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    f = open(file)
+    try:
+        source = f.read()
+    finally:
+        f.close()
+    if not COLLECT_DEF.search(source):
+        plugins[file] = (mtime, None)
+        return None
+    name = os.path.basename(file)[:-3]
+    module = imp.new_module("opentsdb_checks_" + name.replace("-", "_"))
+    module.__file__ = file
+    try:
+        # unlike import, this doesn't leave .pyc files behind in checksdir
+        exec compile(source, file, "exec") in module.__dict__
+    except:
+        LOG.exception("Unable to import check %s, running it as a subprocess" % file)
+        module = None
+    if module is not None and not callable(getattr(module, "collect", None)):
+        module = None
+    plugins[file] = (mtime, module)
+    return module
+
+
+def checks_lib(file):
+    """The directory of the modules shared by the checks, for check file."""
+    return os.path.join(os.path.dirname(os.path.abspath(file)), CHECKS_LIB)
+
+
+def format_datapoint(metric, ts, value, tags):
+    if tags:
+        return "%s %d %s %s" % (metric, ts, value, tags)
+    return "%s %d %s" % (metric, ts, value)
+
+
+class ChunkWriter(object):
+    """Streams the output of one check into the spool.
+
+    Only a partial line (at most READ_LINE_BUF bytes, longer lines are
+    dropped) and up to one spool block of lines are held in memory, and no
+    more than max_bytes are written. Each line is parsed once by parser,
+    which drops what the TSD would refuse (see opentsdb_datapoint). Series
+    matching aggregation rules are rolled up until the check is done (see
+    opentsdb_aggregate), and with a dedup repeated values are held back
+    (see opentsdb_dedup).
+    """
+
+    def __init__(self, spool, parser, max_bytes, dedup=None, rules=None):
+        self.spool = spool
+        self.parser = parser
+        self.max_bytes = max_bytes
+        self.dedup = dedup
+        self.aggregator = rules and opentsdb_aggregate.Aggregator(rules)
+        self.size = 0
+        self.count = 0
+        self.rejected = 0
+        self.first_rejected = None
+        self.lines = []
+        self.buffered = 0
+        self.partial = ''
+        self.overlong = False
+
+    def write_line(self, line):
+        """Appends one line, returns False if it would exceed max_bytes."""
+        line = opentsdb_datapoint.normalize(line)
+        if not line:
+            return True
+        if len(line) > READ_LINE_BUF:
+            LOG.warning("Dropping too long line: %s..." % line[:80])
+            return True
+        if not self.parser.valid(line):
+            if not self.rejected:
+                self.first_rejected = "%s (%s)" % (line,
+                                                   self.parser.explain(line))
+            self.rejected += 1
+            return True
+        if self.aggregator or self.dedup:
+            # only these need the fields
+            return self.write_point(self.parser.point(line))
+        return self.append(line + self.parser.suffix + "\n")
+
+    def write_point(self, point):
+        if self.aggregator and not self.aggregator.add(point):
+            return True
+        return self.store(point)
+
+    def store(self, point):
+        if self.dedup:
+            lines = self.dedup.filter(point, self.parser.suffix)
+            return not lines or self.append(lines, lines.count("\n"))
+        return self.append(point.line(self.parser.suffix))
+
+    def append(self, lines, count=1):
+        """Buffers count newline terminated lines, ready to be spooled."""
+        if self.size + len(lines) > self.max_bytes:
+            return False
+        self.lines.append(lines)
+        self.size += len(lines)
+        self.count += count
+        self.buffered += len(lines)
+        if self.buffered >= opentsdb_spool.BLOCK_SIZE:
+            self.flush()
+        return True
+
+    def write_text(self, text):
+        """Appends newline terminated lines, returns False if they would
+        exceed max_bytes.
+
+        Text that is all valid lines is checked with a single regular
+        expression. Without aggregation and dedup it's then spooled with the
+        tags appended in one go, otherwise its lines are parsed right away.
+        Any other text goes line by line.
+        """
+        suffix = self.parser.suffix
+        count = text.count("\n")
+        if self.parser.invalid(text):
+            for line in text.split("\n")[:-1]:
+                if not self.write_line(line):
+                    return False
+            return True
+        if self.aggregator or self.dedup:
+            point = self.parser.point
+            for line in text.split("\n")[:-1]:
+                if not self.write_point(point(line)):
+                    return False
+            return True
+        if self.size + len(text) + count * len(suffix) > self.max_bytes:
+            # to stop at the last line that fits
+            for line in text.split("\n")[:-1]:
+                if not self.append(line + suffix + "\n"):
+                    return False
+            return True
+        if suffix:
+            text = text.replace("\n", suffix + "\n")
+        return self.append(text, count)
+
+    def feed(self, data):
+        """Appends raw check output, returns False once max_bytes is hit."""
+        if self.overlong:
+            # still inside a line we already gave up on
+            end = data.find("\n")
+            if end < 0:
+                return True
+            data = data[end + 1:]
+            self.overlong = False
+        end = data.rfind("\n") + 1
+        if end:
+            text = self.partial + data[:end]
+            self.partial = data[end:]
+        else:
+            text = ''
+            self.partial += data
+        if len(self.partial) > READ_LINE_BUF:
+            LOG.warning("Dropping too long line: %s..." % self.partial[:80])
+            self.partial = ''
+            self.overlong = True
+        return not text or self.write_text(text)
 
-        for i in range(1, n + 1):
-            signal.signal(signal.SIGALRM, alarm_handler)
-            signal.alarm(timeout)
-            uniq = random.randint(1, 10^20)
+    def flush(self):
+        if self.lines:
+            self.spool.append(''.join(self.lines))
+            self.lines = []
+            self.buffered = 0
+
+    def commit(self):
+        if self.aggregator:
+            for point in self.aggregator.points():
+                self.store(point)
+        self.flush()
+
+    def abort(self):
+        if self.aggregator:
+            self.aggregator.points()
+        self.lines = []
+        self.buffered = 0
+
+
+def run_plugin(file, plugin, confs_dir, timeout, writer):
+    """Runs an in-process check, a batch of datapoints at a time.
+
+    The alarm is armed only while the check itself runs, never around the
+    writer: an Alarm between appending a block to the spool and forgetting
+    it would have the block appended again, and one in the middle of an
+    append would cut it short.
+    """
+    started = time.time()
+    deadline = started + timeout
+    status = 0
+    timed_out = False
+    full = False
+    done = False
+    datapoints = None
+    signal.signal(signal.SIGALRM, alarm_handler)
+    while not done and not full:
+        lines = []
+        try:
+            # setitimer(0) would disarm it rather than fire at once
+            signal.setitimer(signal.ITIMER_REAL,
+                             max(deadline - time.time(), 0.001))
             try:
-                result = StringIO.StringIO(ch[i].communicate()[0])
-                file_name_target = get_cache_dir(config) + "/" + str(timestamp) + "-" + str(uniq)
-                file_name_tmp = file_name_target + ".part"
-                try:
-                    f = open(file_name_tmp, 'a')
-                    while True:
-                        line = result.readline().rstrip()
-                        if not line:
-                            break
-                        f.write(line + tags + "\n")
-                    f.close()
-                    if os.stat(file_name_tmp).st_size == 0:
-                        os.unlink(file_name_tmp)
-                    else:
-                        os.rename(file_name_tmp, file_name_target)
-                except:
-                    LOG.exception("Failed")
-                    if os.path.exists(file_name_tmp):
-                        os.unlink(file_name_tmp)
-                    if os.path.exists(file_name_target):
-                        os.unlink(file_name_target)
-                signal.alarm(0)
+                if datapoints is None:
+                    datapoints = iter(plugin.collect(confs_dir))
+                for datapoint in datapoints:
+                    lines.append(format_datapoint(*datapoint))
+                    if len(lines) >= PLUGIN_BATCH:
+                        break
+                else:
+                    done = True
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        except Alarm:
+            print "Task", file, "killed due to unable to "\
+                                "parse and store output in",\
+                timeout, "sec"
+            status = -signal.SIGALRM
+            timed_out = True
+            done = True
+        except:
+            LOG.exception("Check %s failed" % file)
+            status = 1
+            done = True
+        if lines:
+            try:
+                full = not writer.write_text("\n".join(lines) + "\n")
             except:
-                LOG.exception("Failed")
-                try:
-                    print "Task", p_name[i], "killed due to unable to "\
-                                             "parse and store output in",\
-                    timeout, "sec"
-                    ch[i].kill()
-                except:
-                    continue
-                continue
-
-ts_part = re.compile('([0-9]+).')
-def remove_stale_chunk(cache_dir, fname, min_timestamp):
-    result = ts_part.match(fname)
-    if result:
-        file_ts = long(result.group(1))
-        if file_ts < min_timestamp:
-            LOG.debug("Removing stale chunk %s (%d < %d)" % (fname, file_ts, min_timestamp))
-            os.remove(cache_dir + os.path.sep + fname)
+                LOG.exception("Failed to spool output of %s" % file)
+                writer.abort()
+                status = 1
+                done = True
+    if full:
+        LOG.warning("Check %s exceeded %d bytes of output"
+                    % (file, writer.max_bytes))
+    try:
+        writer.commit()
+    except:
+        LOG.exception("Failed to spool output of %s" % file)
+        writer.abort()
+    record_check(file, time.time() - started, status, timed_out, writer)
+
+
+def record_check(file, duration, status, timed_out, writer):
+    check = os.path.basename(file)
+    stats.add("check.duration", duration, check=check)
+    stats.add("check.exit_status", status, check=check)
+    stats.add("check.timed_out", int(timed_out), check=check)
+    stats.add("check.lines", writer.count, check=check)
+    stats.add("check.bytes", writer.size, check=check)
+    stats.add("check.rejected", writer.rejected, check=check)
+    if writer.rejected:
+        LOG.warning("Dropped %d bad lines of %s, the first: %s"
+                    % (writer.rejected, check, writer.first_rejected))
+
+
+class RunningCheck(object):
+    def __init__(self, file, proc, started, deadline, writer):
+        self.file = file
+        self.proc = proc
+        self.started = started
+        self.deadline = deadline
+        self.writer = writer
+        self.timed_out = False
+
+
+def start_check(file, confs_dir, timeout, writer):
+    if not os.access(file, os.X_OK):
+        try:
+            os.chmod(file, stat.S_IEXEC)
+        except:
             return None
-    return fname
+    try:
+        # own process group, so a timeout also kills whatever the check forked
+        args = [file, confs_dir]
+        if profiler:
+            args = profiler.command(file, args[1:])
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [checks_lib(file)] + filter(None, [env.get("PYTHONPATH")]))
+        proc = subprocess.Popen(args, stdout=PIPE, preexec_fn=os.setpgrp,
+                                env=env)
+    except:
+        print "Unable to run check:", file
+        return None
+    LOG.debug("check: %s (pid %d)" % (file, proc.pid))
+    now = time.time()
+    return RunningCheck(file, proc, now, now + timeout, writer)
+
+
+def reap_check(check, options=0):
+    """Collects the exit status of a check, returns False if it's still
+    running (with os.WNOHANG)."""
+    # wait4() instead of wait(), for what the check used
+    pid, status, rusage = os.wait4(check.proc.pid, options)
+    if not pid:
+        return False
+    if os.WIFSIGNALED(status):
+        check.proc.returncode = -os.WTERMSIG(status)
+    else:
+        check.proc.returncode = os.WEXITSTATUS(status)
+    if profiler:
+        profiler.finished(check.file, rusage)
+    return True
+
+
+def finish_check(check):
+    """Spools the rest of the output of a reaped check."""
+    LOG.debug("check %s exited with %d" % (check.file, check.proc.returncode))
+    try:
+        check.writer.commit()
+    except:
+        LOG.exception("Failed to spool output of %s" % check.file)
+        check.writer.abort()
+    record_check(check.file, time.time() - check.started,
+                 check.proc.returncode, check.timed_out, check.writer)
+
+
+def drain_check(check):
+    """Reads what a check past its deadline has already written; returns
+    True if that reached the end of its output."""
+    fd = check.proc.stdout.fileno()
+    poller = select.poll()
+    poller.register(fd, select.POLLIN)
+    try:
+        while poller.poll(0):
+            data = os.read(fd, READ_BUF)
+            if not data:
+                check.writer.feed("\n")
+                return True
+            if not check.writer.feed(data):
+                LOG.warning("Check %s exceeded %d bytes of output, killed"
+                            % (check.file, check.writer.max_bytes))
+                return False
+    except:
+        LOG.exception("Failed to spool output of %s" % check.file)
+        check.writer.abort()
+    return False
+
 
-def cleanup_chunks(min_timestamp, cache_dir, chunks):
-    return itertools.ifilter(None,
-        itertools.imap(lambda fname: remove_stale_chunk(cache_dir, fname, min_timestamp), chunks))
+def kill_check(check):
+    check.proc.stdout.close()
+    try:
+        os.killpg(check.proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    reap_check(check)
+    finish_check(check)
 
 
-def remove_n_chunks(cache_dir, chunks, to_remove):
-    LOG.debug("Removing overflow %d chunks" % to_remove)
-    for chunk in chunks:
-        os.remove(cache_dir + os.path.sep + chunk)
-        LOG.debug("Removing overflow %s chunk (%d)" % (chunk, to_remove))
-        to_remove -= 1
-        if to_remove <= 0:
-            break
+def timed_out(check, timeout):
+    print "Task", check.file, "killed due to unable to "\
+                              "parse and store output in",\
+        timeout, "sec"
+    check.timed_out = True
+    kill_check(check)
 
 
-def send_outstanding(config):
+def call_checks(run_checks, config):
+    """Runs checks and spools their output.
+
+    Subprocess checks run at most max_running at a time and all their pipes
+    are read together with poll(), each check killed at its own deadline
+    once what it already wrote has been read; one that closed its output
+    but hasn't exited by then is killed too. In-process checks are run in
+    between, on this thread: the subprocess checks may wait on a full pipe
+    meanwhile, so the time they take is added to their deadlines. Output is
+    streamed line by line into the spool, so memory use doesn't depend on
+    how much a check prints.
+    """
+    checks_dir = config.get(MAIN_SECTION, CHECKSDIR_KEY)
+    confs_dir = config.get(MAIN_SECTION, CONFIGDIR_KEY)
+    spool = get_spool(config)
     timeout = config.getint(MAIN_SECTION, TIMEOUT_KEY)
+    max_running = config.getint(MAIN_SECTION, MAX_RUNNING_KEY)
+    max_output = config.getint(MAIN_SECTION, MAX_OUTPUT_KEY)
+    inprocess = config.getboolean(MAIN_SECTION, INPROCESS_KEY)
+    dedup_interval = config.getint(MAIN_SECTION, DEDUP_INTERVAL_KEY)
+    parser = get_parser(config)
+    rules = get_aggregation_rules(config)
+    if not os.path.exists(checks_dir):
+        return
+    dedup = None
+    if dedup_interval > 0:
+        dedup = opentsdb_dedup.Dedup(get_cache_dir(config), dedup_interval)
+    checks = list_checks(run_checks, config)
+    LOG.debug("run checks: %s" % checks)
+    pending = []
+    in_process = []
+    for check in checks:
+        file = checks_dir + "/" + check
+        if not os.path.isfile(file):
+            continue
+        plugin = inprocess and load_plugin(file)
+        if plugin:
+            LOG.debug("in-process check: %s" % file)
+            in_process.append((file, plugin))
+        else:
+            pending.append(file)
+
+    poller = select.poll()
+    running = {}
+    # checks whose output ended, waiting to be reaped
+    exiting = []
+    while pending or running or exiting or in_process:
+        while pending and len(running) + len(exiting) < max_running:
+            writer = ChunkWriter(spool, parser, max_output, dedup, rules)
+            check = start_check(pending.pop(0), confs_dir, timeout, writer)
+            if check:
+                fd = check.proc.stdout.fileno()
+                running[fd] = check
+                poller.register(fd, select.POLLIN)
+
+        if in_process:
+            wait = 0
+        elif running or exiting:
+            deadline = min(check.deadline for check in
+                           running.values() + exiting)
+            wait = max(0, deadline - time.time())
+            if exiting:
+                # there's no fd to poll for an exit
+                wait = min(wait, REAP_INTERVAL)
+        else:
+            continue
+        for fd, event in poller.poll(int(wait * 1000)):
+            check = running[fd]
+            data = os.read(fd, READ_BUF)
+            try:
+                if data:
+                    if check.writer.feed(data):
+                        continue
+                    LOG.warning("Check %s exceeded %d bytes of output, killed"
+                                % (check.file, max_output))
+                else:
+                    check.writer.feed("\n")
+            except:
+                LOG.exception("Failed to spool output of %s" % check.file)
+                check.writer.abort()
+            poller.unregister(fd)
+            del running[fd]
+            if data:
+                kill_check(check)
+            else:
+                check.proc.stdout.close()
+                exiting.append(check)
+
+        now = time.time()
+        for fd, check in running.items():
+            if check.deadline <= now:
+                poller.unregister(fd)
+                del running[fd]
+                if drain_check(check):
+                    check.proc.stdout.close()
+                    exiting.append(check)
+                else:
+                    timed_out(check, timeout)
+
+        for check in exiting[:]:
+            if reap_check(check, os.WNOHANG):
+                exiting.remove(check)
+                finish_check(check)
+            elif check.deadline <= now:
+                exiting.remove(check)
+                timed_out(check, timeout)
+
+        if in_process:
+            file, plugin = in_process.pop(0)
+            writer = ChunkWriter(spool, parser, max_output, dedup, rules)
+            started = time.time()
+            if profiler:
+                profiler.check(file, run_plugin, file, plugin, confs_dir,
+                               timeout, writer)
+            else:
+                run_plugin(file, plugin, confs_dir, timeout, writer)
+            # nobody read the pipes of the others meanwhile
+            spent = time.time() - started
+            for check in running.itervalues():
+                check.deadline += spent
+
+    if dedup:
+        held = dedup.expire(time.time())
+        if held:
+            spool.append(held)
+        dedup.save()
+    segments, size = spool.usage()
+    stats.add("spool.segments", segments)
+    stats.add("spool.bytes", size)
+    spool_stats(config, spool)
+    spool.commit()
+
+
+def spool_stats(config, spool):
+    """Appends what was collected in stats to the spool, tagged like the
+    output of the checks."""
+    lines = stats.lines()
+    if not config.getboolean(MAIN_SECTION, SELF_METRICS_KEY):
+        return
+    writer = ChunkWriter(spool, get_parser(config), sys.maxint)
+    for line in lines:
+        writer.write_line(line)
+    writer.commit()
+
+def send_outstanding(config, deadline=None, seal=True):
+    """Drains the spool over a pool of connections spread across all hosts.
+
+    Each connection takes the next segment (or lane of one) from a shared
+    queue, so the drain rate grows with the number of healthy TSDs, up to
+    the drain limits. The order is set by opentsdb_drain. A segment whose
+    connection fails goes back to the queue and continues from its
+    checkpoint.
+
+    Only one process drains a spool at a time. Past deadline (if not None)
+    no more batches are sent; returns True if that left segments behind.
+    """
+    spool = get_spool(config)
+    lock = spool.lock_send()
+    if lock is None:
+        LOG.info("Another process is sending %s" % get_cache_dir(config))
+        return False
+    try:
+        return send_spool(config, spool, deadline, seal)
+    finally:
+        spool.unlock(lock)
+
+
+def send_spool(config, spool, deadline, seal):
     max_chunks = config.getint(MAIN_SECTION, MAX_CHUNKS_KEY)
+    max_spool_bytes = config.getint(MAIN_SECTION, MAX_SPOOL_BYTES_KEY)
     retention = config.getint(MAIN_SECTION, RETENTION_KEY)
+    connections = config.getint(MAIN_SECTION, SEND_CONNECTIONS_KEY)
     servers = get_servers(config)
     random.shuffle(servers)
-    cache_dir = get_cache_dir(config)
-    listing = sorted(os.listdir(cache_dir))
-    chunks = ifilter(lambda fname: rfind(fname, '.part') != 5, listing)
+    spool.expire(time.time() - retention, max_chunks, max_spool_bytes)
+    if spool.empty():
+        LOG.debug("No segments found for %s" % (servers))
+        return False
+    down = set()
+    sender, server = connect_any(config, servers, down)
+    if not sender:
+        LOG.error("No TSD available in %s" % servers)
+        spool_stats(config, spool)
+        spool.commit()
+        return False
+    if seal:
+        # seal only once a TSD is up, so an outage piles up
+        # datapoints in fewer, bigger segments
+        spool.seal()
+    started = time.time()
+    segments = spool.segments()
+    if segments:
+        stats.add("send.oldest_age", started - segments[0].min_ts)
+        stats.add("send.newest_age",
+                  started - max(segment.max_ts for segment in segments))
+    drain = opentsdb_drain.Drain(spool, segments, get_lanes(config),
+                                 config.getint(MAIN_SECTION, DRAIN_BYTES_KEY),
+                                 config.getint(MAIN_SECTION, DRAIN_POINTS_KEY),
+                                 deadline,
+                                 config.getint(MAIN_SECTION, SEND_BATCH_KEY))
+    LOG.debug("Sending %d segments and lanes to %s" % (len(drain), servers))
+    worker = connect_and_send
+    if profiler:
+        worker = profiler.thread(worker)
+    workers = [threading.Thread(target=worker,
+                                args=(servers, config, down, drain, sender,
+                                      server))]
+    for i in range(1, min(connections, len(drain))):
+        # start each connection on a different host
+        first = i % len(servers)
+        workers.append(threading.Thread(target=worker,
+                                        args=(servers[first:] + servers[:first],
+                                              config, down, drain)))
+    for worker in workers:
+        worker.setDaemon(True)
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if drain.out_of_time and len(drain):
+        LOG.info("Out of time, %d segments and lanes left for the next run"
+                 % len(drain))
+    elif len(drain):
+        LOG.warning("%d segments and lanes left for the next run" % len(drain))
+    duration = time.time() - started
+    stats.add("send.duration", duration)
+    stats.add("send.bytes_per_second",
+              stats.get("send.bytes") / max(duration, 0.001))
+    spool_stats(config, spool)
+    spool.commit()
+    return drain.out_of_time and len(drain) > 0
 
-    to_remove = len(listing) - max_chunks
-    if to_remove > 0:
-        remove_n_chunks(cache_dir, chunks, to_remove)
 
-    chunks = list(cleanup_chunks(timestamp - retention, cache_dir, chunks))
-    if not chunks or len(chunks) == 0:
-        LOG.debug("No chunks found for %s" % (servers))
-        return
-    LOG.debug("Found chunks %s for %s" % (chunks, servers))
-    LOG.debug("Sending %s to %s" % (chunks, servers))
+def connect_any(config, servers, down):
+    """Returns a verified sender for the first server not known to be
+    down, as (sender, server), or (None, None)."""
     for server in servers:
-        try:
-            con = mk_conn(server, timeout)
-            if not con:
-                time.sleep(random.randint(0, 5)) # spread load
-                continue
+        if server in down:
+            continue
+        host, port = server.split(':')
+        started = time.time()
+        sender = open_sender(config, server)
+        if sender:
             try:
-                verify_conn(con)
-                for chunk in chunks:
-                    send_file(con, cache_dir + os.path.sep + chunk)
-                    LOG.debug("Done %s to %s" % (chunk, server))
-                verify_conn(con)
+                sender.verify()
+                stats.add("send.connect_time", time.time() - started,
+                          tsd=host, port=port)
+                return sender, server
+            except SEND_ERRORS, e:
+                LOG.warning("TSD %s is not responding: %s" % (server, e))
+                sender.close()
+        stats.count("send.connect_errors", tsd=host, port=port)
+        down.add(server)
+    return None, None
 
-            finally:
-                con.close()
-        except:
-            LOG.exception("Can't send to %s" % server)
-            continue
-        break
+
+def open_sender(config, server):
+    """Returns a sender for the configured transport, or None if server
+    can't be reached. Senders have verify(), send(lines) and close(), and
+    count the send() calls the TSD confirmed in batches."""
+    timeout = config.getint(MAIN_SECTION, TIMEOUT_KEY)
+    transport = config.get(MAIN_SECTION, TRANSPORT_KEY)
+    if transport == HTTP_TRANSPORT:
+        return opentsdb_http.HttpSender(
+            server, timeout, config.getint(MAIN_SECTION, HTTP_BATCH_KEY),
+            config.getint(MAIN_SECTION, HTTP_COMPRESS_LEVEL_KEY))
+    if transport != TELNET_TRANSPORT:
+        raise ValueError("Unknown transport %r" % transport)
+    con = mk_conn(server, timeout)
+    if con:
+        return TelnetSender(con)
+
+
+class TelnetSender(object):
+    """Sends spooled lines as "put" commands over a raw socket."""
+
+    def __init__(self, con):
+        self.con = con
+        self.reader = LineReader(con)
+        self.batches = 0
+
+    def verify(self):
+        verify_conn(self.con, self.reader)
+
+    def send(self, lines):
+        """Returns once the TSD has processed all of lines, with (line,
+        error) for the lines it rejected."""
+        send_draining(self.con, self.reader,
+                      "put " + lines[:-1].replace("\n", "\nput ") + "\n")
+        errors = barrier(self.con, self.reader)
+        self.batches += 1
+        return match_errors(lines, errors)
+
+    def close(self):
+        self.con.close()
+
+
+class LineReader(object):
+    """Buffered reader for the lines the TSD writes back."""
+
+    def __init__(self, con):
+        self.con = con
+        self.partial = ""
+        self.lines = deque()
+
+    def fill(self):
+        data = self.con.recv(READ_BUF)
+        if not data:
+            raise socket.error(errno.ECONNRESET, "TSD closed the connection")
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        self.lines.extend(lines)
+
+    def readline(self):
+        while not self.lines:
+            self.fill()
+        return self.lines.popleft()
+
+
+def connect_and_send(servers, config, down, drain, sender=None, server=None):
+    """Sends from drain over a connection to the first of servers that is
+    up, connecting again when it fails.
+
+    A TSD that drops connections partway through a batch would otherwise
+    get the same first lines over and over: after a connection that
+    didn't get a single batch confirmed, the batches of the drain are
+    halved, down to opentsdb_drain.MIN_BATCH.
+    """
+    while True:
+        if sender is None:
+            sender, server = connect_any(config, servers, down)
+            if sender is None:
+                return
+        confirmed = send_worker(sender, server, drain)
+        if confirmed is None or not confirmed and not drain.shrink():
+            return
+        sender = None
+
+
+def send_worker(sender, server, drain):
+    """Sends until the drain is empty or out of time, then returns None, or
+    until the connection fails, then returns the number of batches the TSD
+    confirmed over it."""
+    try:
+        while True:
+            unit = drain.next()
+            if unit is None:
+                return None
+            lane, segment = unit
+            try:
+                if not send_segment(sender, drain, lane, segment):
+                    # out of time, continues from the checkpoint next run
+                    drain.retry(lane, segment)
+                    return None
+                LOG.debug("Done %s lane %s to %s" % (segment.name, lane, server))
+            except SEND_ERRORS, e:
+                LOG.error("Can't send to %s: %s" % (server, e))
+                drain.retry(lane, segment)
+                return sender.batches
+            except:
+                LOG.exception("Can't send %s to %s" % (segment.name, server))
+    finally:
+        sender.close()
 
 
 def mk_conn(server, timeout):
@@ -265,8 +995,8 @@ def mk_conn(server, timeout):
     port = int(server.split(':')[1].rstrip())
     try:
         con = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # keeps blocking semantics, but a stalled TSD can't hang a barrier
         con.settimeout(timeout)
-        con.setblocking(True)
         con.connect((host, port))
         # if we get here it connected
     except socket.error, msg:
@@ -279,54 +1009,225 @@ def mk_conn(server, timeout):
     return con
 
 
-def verify_conn(con):
+def verify_conn(con, reader):
     LOG.debug('verifying TSD is alive')
-    send_msg(con, "version\n")
+    for error in barrier(con, reader):
+        LOG.warning("TSD: %s" % error)
+
+
+def barrier(con, reader):
+    """Waits until the TSD has processed everything sent so far.
+
+    The TSD handles the commands of a connection in order, so once the reply
+    to "version" is back every put before it has been applied or rejected.
+    The reply ends with a "Built on ..." line; the lines before it, other
+    than the version itself, are returned as errors the TSD reported for
+    some of the puts.
+    """
+    send_draining(con, reader, "version\n")
+    errors = []
+    while True:
+        line = reader.readline()
+        if line.startswith("Built on"):
+            return errors
+        if not line.startswith("net.opentsdb"):
+            errors.append(line)
+
 
+def send_draining(con, reader, data):
+    """sendall() which keeps reading what the TSD writes back meanwhile, so
+    a flood of error lines can't fill up the socket buffers of both ends
+    and stall the connection."""
+    poller = select.poll()
+    poller.register(con, select.POLLIN | select.POLLOUT)
+    timeout = con.gettimeout()
+    if timeout is not None:
+        timeout *= 1000
+    view = buffer(data)
+    sent = 0
+    while sent < len(data):
+        events = poller.poll(timeout)
+        if not events:
+            raise socket.timeout("timed out")
+        for fd, event in events:
+            if event & (select.POLLIN | select.POLLERR | select.POLLHUP):
+                reader.fill()
+            if event & select.POLLOUT:
+                sent += con.send(view[sent:sent + SEND_BUF])
 
-def send_file(con, filename):
+
+def match_errors(lines, errors):
+    """Finds the lines the TSD errors are about.
+
+    The telnet protocol doesn't say which put an error is for, but the
+    messages quote the metric or tag that was refused. Returns (line,
+    error) for every line whose metric, tag name or tag value (or whole
+    tag) is exactly that; errors without a match are logged.
+    """
+    tokens = {}
+    for error in errors:
+        quoted = QUOTED.findall(error)
+        if quoted:
+            tokens.setdefault(quoted[-1], error)
+        else:
+            LOG.warning("TSD: %s" % error)
+    rejected = []
+    if tokens:
+        matched = set()
+        for line in lines.splitlines():
+            fields = line.split()
+            names = fields[:1]
+            for tag in fields[3:]:
+                names.append(tag)
+                names.extend(tag.split("=", 1))
+            for name in names:
+                error = tokens.get(name)
+                if error is not None:
+                    rejected.append((line, error))
+                    matched.add(name)
+                    break
+        for token in set(tokens) - matched:
+            LOG.warning("TSD: %s" % tokens[token])
+    return rejected
+
+
+def split_rejected(lines):
+    """Separates the lines the TSD would refuse, returns the other lines and
+    (line, reason) for each of those."""
+    bad = BAD_LINE.findall(lines)
+    if not bad:
+        return lines, []
+    return (BAD_LINE.sub("", lines),
+            [(line[:-1], "not a valid datapoint") for line in bad])
+
+
+def send_segment(sender, drain, lane, segment):
+    """Sends a lane of a sealed segment from the offset delivered so far.
+
+    After every batch the sender waits for the TSD to confirm it before the
+    new offset is recorded, so a dropped connection only resends the batch
+    that was in flight. The segment is removed once all of it is confirmed.
+    Returns False if the drain ran out of time before that.
+    """
+    spool = drain.spool
     chunks = []
     inbuf = 0
-    f = open(filename)
-    while True:
-        message = f.readline()
-        if not message:
-            break
-        chunk = "put " + message
-        inbuf += len(chunk)
-        chunks += [chunk]
-        if inbuf > WRITE_BUF:
-            LOG.debug('flushing %d lines' % (len(chunks)))
-            con.sendall(''.join(chunks))
-            chunks, inbuf = ([], 0)
-    f.close()
-    if len(chunks) > 0:
-        LOG.debug('flushing %d lines' % (len(chunks)))
-        con.sendall(''.join(chunks))
-    os.unlink(filename)
-
-
-def send_msg(socket, msg):
-    socket.sendall(msg)
-    return recv_line(socket)
-
-def recv_line(socket):
-    buffer = socket.recv(1)
+    count = 0
+    offset = spool.offset(segment.name, lane)
+    try:
+        for offset, lines in spool.read(segment.name, offset):
+            lines = drain.select(lines, lane)
+            inbuf += len(lines)
+            count += lines.count("\n")
+            chunks.append(lines)
+            if inbuf > drain.batch or drain.full(inbuf, count):
+                if not flush_batch(sender, drain, lane, segment, offset,
+                                   chunks, inbuf):
+                    return False
+                chunks, inbuf, count = ([], 0, 0)
+                if drain.expired():
+                    return False
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        LOG.error("Segment %s is gone" % segment.name)
+    if inbuf > 0:
+        if not flush_batch(sender, drain, lane, segment, offset, chunks,
+                           inbuf):
+            return False
+    drain.done(lane, segment)
+    return True
+
+
+def flush_batch(sender, drain, lane, segment, offset, chunks, inbuf):
+    """Sends a batch and records the offset after it, returns False if the
+    drain limits held it back past the deadline."""
+    LOG.debug('flushing %d bytes of %s' % (inbuf, segment.name))
+    lines, rejected = split_rejected(''.join(chunks))
+    if lines:
+        if not drain.limit(lines):
+            return False
+        rejected.extend(sender.send(lines))
+        stats.count("send.lines", lines.count("\n"))
+        stats.count("send.bytes", len(lines))
+    if rejected:
+        LOG.warning("Quarantining %d lines of %s" % (len(rejected), segment.name))
+        drain.spool.quarantine(rejected)
+        stats.count("send.rejected", len(rejected))
+    drain.spool.set_offset(segment.name, offset, lane)
+    return True
+
+
+def next_run(last_run, interval, now):
+    """Keeps a fixed rate, but skips runs missed while we were busy."""
+    run = last_run + interval
+    if run <= now:
+        run = now + interval
+    return run
+
+
+def run_phase(name, func, *args):
+    if profiler:
+        return profiler.phase(name, func, *args)
+    return func(*args)
+
+
+def run_daemon(run_checks, config, options):
+    """Runs checks and sends datapoints forever.
+
+    Every check is scheduled on its own interval (see the Intervals section),
+    so the interpreter and config are set up only once instead of on every
+    cron run. Sending stops when the next check is due (or after
+    send_interval); a backlog left by that is sent on in the gaps between
+    checks, which keep their schedule.
+    """
+    send_interval = config.getint(MAIN_SECTION, SEND_INTERVAL_KEY)
+    schedule = {}
+    next_send = next_seal = time.time()
     while True:
-        if "\n" in buffer:
-            (line, buffer) = buffer.split("\n", 1)
-            return line
-        else:
-            more = socket.recv(1)
-            if not more:
-                break
-            else:
-                buffer = buffer + more
-    if buffer:
-        return buffer
+        now = time.time()
+        if not options.send_only:
+            checks = list_checks(run_checks, config)
+            schedule = dict((check, schedule.get(check, now)) for check in checks)
+            due = set()
+            for check, when in schedule.iteritems():
+                if when <= now:
+                    due.add(check)
+                    schedule[check] = next_run(when, get_interval(config, check), now)
+            if due:
+                LOG.debug("due checks: %s" % due)
+                try:
+                    run_phase("checks", call_checks, due, config)
+                except:
+                    LOG.exception("Failed to run checks %s" % due)
+
+        wakeups = schedule.values()
+        if not options.check_only:
+            now = time.time()
+            if next_send <= now:
+                deadline = max(min(wakeups + [now + send_interval]),
+                               now + MIN_SEND_TIME)
+                seal = next_seal <= now
+                behind = False
+                try:
+                    behind = run_phase("send", send_outstanding, config,
+                                       deadline, seal)
+                except:
+                    LOG.exception("Failed to send outstanding chunks")
+                if seal:
+                    next_seal = next_run(next_seal, send_interval, time.time())
+                next_send = behind and time.time() or next_seal
+            wakeups.append(next_send)
+
+        if not wakeups:
+            LOG.error("Nothing to schedule, exiting")
+            return 1
+        time.sleep(max(0, min(wakeups) - time.time()))
+
 
 def main(argv):
     """The main entry point and loop."""
+    global profiler
 
     options, args = parse_cmdline(argv)
     setup_logging(options.use_syslog)
@@ -337,16 +1238,25 @@ def main(argv):
     config = read_config(options.config)
     init_caches(config)
 
+    if options.profile or options.profile_memory:
+        profiler = opentsdb_profile.Profiler(
+            options.profile_dir or os.path.join(get_cache_dir(config), "profile"),
+            options.profile, options.profile_memory)
+
+    if options.run_checks:
+        checks_set = set(options.run_checks.split(","))
+    else:
+        checks_set = None
+
+    if options.daemon:
+        return run_daemon(checks_set, config, options)
+
     if not options.send_only:
-        if options.run_checks:
-            checks_set = set(options.run_checks.split(","))
-        else:
-            checks_set = None
-        call_checks(checks_set, config)
+        run_phase("checks", call_checks, checks_set, config)
 
     if not options.check_only:
         time.sleep(random.randint(0, 5))
-        send_outstanding(config)
+        run_phase("send", send_outstanding, config)
     else:
         LOG.debug("Send prohibited.")
 
@@ -0,0 +1,118 @@
+"""Parses and validates check output, once per line, before it's spooled.
+
+A line is "metric timestamp value tag=value ...", the telnet put command
+without "put". What the TSD would refuse is dropped right away, so it takes
+neither spool space nor TSD time: names are letters, digits, -_./ or non
+ascii, the timestamp is in seconds (up to 10 digits) or milliseconds (13),
+the value is a decimal number, and together with the tags of the Tags
+section a datapoint has from 1 to max_tags tags, none of them redefining one
+of the Tags section.
+"""
+import re
+
+NAME = r'[-a-zA-Z0-9_./\x80-\xff]+'
+NUMBER = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+TIMESTAMP = r'(?:\d{1,10}|\d{13})'
+# for telling what is wrong with a line
+IS_NAME = re.compile(NAME + '$').match
+IS_TIMESTAMP = re.compile(TIMESTAMP + '$').match
+IS_NUMBER = re.compile(NUMBER + '$').match
+IS_TAG = re.compile(r'%s=%s$' % (NAME, NAME)).match
+
+
+def normalize(line):
+    """Strips line and squeezes the spaces between its fields."""
+    line = line.strip()
+    if "  " in line:
+        return " ".join(line.split())
+    return line
+
+
+class Datapoint(object):
+    """One datapoint, with its own tags as "tag=value ..." (not those of
+    the Tags section) and the value as the check printed it."""
+
+    __slots__ = ("metric", "ts", "value", "tags")
+
+    def __init__(self, metric, ts, value, tags=""):
+        self.metric = metric
+        self.ts = ts
+        self.value = value
+        self.tags = tags
+
+    def key(self, suffix=""):
+        """The series, as "metric tag=value ..." with suffix appended."""
+        if self.tags:
+            return "%s %s%s" % (self.metric, self.tags, suffix)
+        return self.metric + suffix
+
+    def line(self, suffix=""):
+        """The newline terminated spool line, with suffix appended."""
+        if self.tags:
+            return "%s %d %s %s%s\n" % (self.metric, self.ts, self.value,
+                                        self.tags, suffix)
+        return "%s %d %s%s\n" % (self.metric, self.ts, self.value, suffix)
+
+
+class Parser(object):
+    """Validates lines of check output that get tags appended.
+
+    tags is " tag=value ..." as get_tags() returns it. It's serialized only
+    once and appended as it is, and the whole check of a line, the number
+    of tags and clashes with tags included, is one regular expression, which
+    can also check a whole block of lines at once.
+    """
+
+    def __init__(self, tags="", max_tags=8, max_length=1024):
+        self.suffix = tags
+        self.keys = [tag.split("=", 1)[0] for tag in tags.split()]
+        self.max_tags = max_tags
+        tag = r'%s=%s' % (NAME, NAME)
+        if self.keys:
+            tag = r'(?!(?:%s)=)%s' % ("|".join(map(re.escape, self.keys)), tag)
+        line = r'%s %s %s(?: %s){%d,%d}' % (NAME, TIMESTAMP, NUMBER, tag,
+                                          not self.keys,
+                                          max(max_tags - len(self.keys), 0))
+        self.valid = re.compile(line + '$').match
+        # finds the first line of a newline terminated text that valid()
+        # refuses or that is longer than max_length; the others are spooled
+        # as they are
+        self.invalid = re.compile(r'^(?!(?=.{0,%d}\n)%s\n).*\n'
+                                  % (max_length, line), re.M).search
+
+    def parse(self, line):
+        """Returns line, normalized, as a Datapoint; raises ValueError
+        saying what is wrong with it."""
+        line = normalize(line)
+        if not self.valid(line):
+            raise ValueError(self.explain(line))
+        return self.point(line)
+
+    def point(self, line):
+        """Returns a line valid() accepted as a Datapoint."""
+        fields = line.split(" ", 3)
+        if len(fields) == 4:
+            return Datapoint(fields[0], int(fields[1]), fields[2], fields[3])
+        return Datapoint(fields[0], int(fields[1]), fields[2])
+
+    def explain(self, line):
+        """Says what is wrong with a normalized line valid() refused."""
+        fields = line.split(" ")
+        if len(fields) < 3:
+            return "expected a metric, a timestamp and a value"
+        if not IS_NAME(fields[0]):
+            return "bad metric name %r" % fields[0]
+        if not IS_TIMESTAMP(fields[1]):
+            return "bad timestamp %r" % fields[1]
+        if not IS_NUMBER(fields[2]):
+            return "bad value %r" % fields[2]
+        for tag in fields[3:]:
+            if not IS_TAG(tag):
+                return "bad tag %r" % tag
+            if tag.split("=", 1)[0] in self.keys:
+                return "tag %r redefines one of the Tags section" % tag
+        if len(fields) == 3 and not self.keys:
+            return "no tags"
+        if len(fields) - 3 + len(self.keys) > self.max_tags:
+            return "more than %d tags" % self.max_tags
+        return "not a valid datapoint"
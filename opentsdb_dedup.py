@@ -0,0 +1,95 @@
+"""Holds back datapoints that repeat the last value of their series.
+
+A series (metric and tags) whose value hasn't changed is written again only
+once dedup_interval seconds have passed since its last written point. When
+the value does change, the last point held back is written first, so graphs
+still show until when the old value lasted. The last value of every series
+is kept in cachedir/dedup.state, which makes this work across cron runs.
+"""
+import errno
+import logging
+import marshal
+import os
+
+import opentsdb_spool
+
+LOG = logging.getLogger('opentsdb_checks.dedup')
+
+STATE = "dedup.state"
+# like the TSD, anything beyond 32 bits is a timestamp in milliseconds
+MAX_SECONDS = 0xffffffff
+
+
+def seconds(ts):
+    if ts > MAX_SECONDS:
+        return ts // 1000
+    return ts
+
+
+def format_line(key, ts, value):
+    metric, _, tags = key.partition(" ")
+    if tags:
+        return "%s %d %s %s\n" % (metric, ts, value, tags)
+    return "%s %d %s\n" % (metric, ts, value)
+
+
+class Dedup(object):
+
+    def __init__(self, cache_dir, interval):
+        self.path = os.path.join(cache_dir, STATE)
+        self.interval = interval
+        # "metric tags" -> (value, ts written, ts last seen)
+        self.series = self.load()
+
+    def load(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        try:
+            try:
+                series = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                series = None
+        finally:
+            f.close()
+        if not isinstance(series, dict):
+            LOG.error("Bad dedup state in %s, starting over" % self.path)
+            return {}
+        return series
+
+    def save(self):
+        opentsdb_spool.write_atomically(self.path, marshal.dumps(self.series))
+
+    def filter(self, point, suffix=""):
+        """Returns the newline terminated lines to write for a Datapoint
+        getting suffix appended, which is empty when it's held back."""
+        key = point.key(suffix)
+        ts = point.ts
+        value = point.value
+        last = self.series.get(key)
+        self.series[key] = (value, ts, ts)
+        if last is None:
+            return format_line(key, ts, value)
+        last_value, written, seen = last
+        if value == last_value:
+            if 0 <= seconds(ts) - seconds(written) < self.interval:
+                self.series[key] = (value, written, ts)
+                return ""
+        elif seen != written:
+            return format_line(key, seen, last_value) + format_line(key, ts, value)
+        return format_line(key, ts, value)
+
+    def expire(self, now):
+        """Forgets the series not seen for dedup_interval, which would be
+        written anyway the next time, and returns their held back points."""
+        lines = []
+        min_seen = now - self.interval
+        for key, (value, written, seen) in self.series.items():
+            if seconds(seen) < min_seen:
+                del self.series[key]
+                if seen != written:
+                    lines.append(format_line(key, seen, value))
+        return "".join(lines)
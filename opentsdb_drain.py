@@ -0,0 +1,226 @@
+"""Decides in which order and how fast the spool is drained.
+
+After an outage every host has a backlog, and sending all of it at full
+speed knocks the TSDs over again. Segments are sent newest first, so
+dashboards catch up before the old data trickles in, at no more than
+drain_bytes and drain_points per second (0 for no limit) over all the
+connections. A run may be given a deadline: no batch is started that the
+limits would hold back past it, and what is left waits for the next run,
+so a daemon goes on collecting while it catches up.
+
+The Priorities section splits datapoints into lanes by metric prefix:
+
+    [Priorities]
+    0 = proc.loadavg proc.stat
+    1 = proc. net.
+
+Lower numbers are sent first, the lane from every segment before the next
+lane. A metric goes in the lane of its longest matching prefix, metrics
+matching none are sent last. Each lane of a segment has its own checkpoint,
+and the segment is removed once all of its lanes are delivered.
+"""
+import Queue
+import logging
+import threading
+import time
+
+LOG = logging.getLogger('opentsdb_checks.drain')
+
+# lane of the metrics matching no prefix
+LAST_LANE = 1 << 30
+# bytes below which batches aren't shrunk, a spool block
+MIN_BATCH = 64 * 1024
+
+
+class TokenBucket(object):
+    """Lets through rate units per second, after a burst of up to one
+    second's worth. Taking more than there is leaves a debt the next taker
+    waits for, so a batch may be bigger than the bucket.
+
+    take() returns False, taking nothing, if the wait would end after
+    deadline, unless the bucket is full: a batch bigger than what the
+    deadline allows still goes through when nothing else is waiting.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, amount, deadline=None):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            wait = (amount - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline \
+                    and self.tokens < self.rate:
+                return False
+            self.tokens -= amount
+        finally:
+            self.lock.release()
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def give(self, amount):
+        """Returns what was taken but not used."""
+        self.lock.acquire()
+        try:
+            self.tokens += amount
+        finally:
+            self.lock.release()
+
+
+# by unit and rate, kept between the runs of a daemon: a run cut short by
+# its deadline must not let the next one start with a fresh burst
+buckets = {}
+
+
+def get_bucket(unit, rate):
+    bucket = buckets.get((unit, rate))
+    if bucket is None:
+        bucket = buckets[(unit, rate)] = TokenBucket(rate)
+    return bucket
+
+
+class Lanes(object):
+
+    def __init__(self, items):
+        self.prefixes = []
+        lanes = set()
+        for lane, prefixes in items:
+            try:
+                lane = int(lane)
+            except ValueError:
+                LOG.error("Bad priority %r, expected a number" % lane)
+                continue
+            lanes.add(lane)
+            self.prefixes.extend((prefix, lane) for prefix in prefixes.split())
+        # longest prefix first
+        self.prefixes.sort(key=lambda (prefix, lane): -len(prefix))
+        self.lanes = sorted(lanes) + [LAST_LANE]
+        self.metrics = {}
+
+    def lane(self, metric):
+        lane = self.metrics.get(metric)
+        if lane is None:
+            lane = LAST_LANE
+            for prefix, prefix_lane in self.prefixes:
+                if metric.startswith(prefix):
+                    lane = prefix_lane
+                    break
+            self.metrics[metric] = lane
+        return lane
+
+    def select(self, lines, lane):
+        """Returns the lines of lane out of newline terminated lines."""
+        lane_of = self.lane
+        return "".join(line for line in lines.splitlines(True)
+                       if lane_of(line[:line.find(" ")]) == lane)
+
+
+class Drain(object):
+    """The segments left to send in this run, as (lane, segment) units in
+    the order they are to be sent, shared by all sender threads. Past
+    deadline (if not None) no more units are handed out. Lines are sent in
+    batches of about batch bytes, see shrink()."""
+
+    def __init__(self, spool, segments, lanes=None, max_bytes=0, max_points=0,
+                 deadline=None, batch=2 * 1024 * 1024):
+        self.spool = spool
+        self.lanes = lanes
+        self.deadline = deadline
+        self.batch = batch
+        self.out_of_time = False
+        self.bytes = max_bytes and get_bucket("bytes", max_bytes)
+        self.points = max_points and get_bucket("points", max_points)
+        self.queue = Queue.PriorityQueue()
+        self.left = {}
+        self.lock = threading.Lock()
+        for segment in segments:
+            segment_lanes = lanes and lanes.lanes or [None]
+            self.left[segment.name] = len(segment_lanes)
+            for lane in segment_lanes:
+                self.queue.put((lane, -segment.max_ts, segment.name, segment))
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def next(self):
+        """Returns the next (lane, segment) to send, or None."""
+        if self.expired():
+            return None
+        try:
+            lane, _, _, segment = self.queue.get_nowait()
+        except Queue.Empty:
+            return None
+        return lane, segment
+
+    def retry(self, lane, segment):
+        self.queue.put((lane, -segment.max_ts, segment.name, segment))
+
+    def select(self, lines, lane):
+        if lane is None:
+            return lines
+        return self.lanes.select(lines, lane)
+
+    def shrink(self):
+        """Halves the batches after a connection failed before the TSD
+        confirmed one, returns False if they are as small as they get."""
+        self.lock.acquire()
+        try:
+            if self.batch <= MIN_BATCH:
+                return False
+            self.batch = max(self.batch / 2, MIN_BATCH)
+            LOG.info("Sending batches of %d bytes" % self.batch)
+            return True
+        finally:
+            self.lock.release()
+
+    def expired(self):
+        """Whether the deadline has passed, what's left waits for the next
+        run."""
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.out_of_time = True
+        return self.out_of_time
+
+    def full(self, size, count):
+        """Whether a batch of size bytes and count lines is a second's worth
+        of the limits, which is as big as batches get while draining at a
+        limited rate."""
+        return bool(self.bytes and size >= self.bytes.rate
+                    or self.points and count >= self.points.rate)
+
+    def limit(self, lines):
+        """Waits until lines may be sent. Returns False at once if that
+        would be after the deadline, the lines are then left for the next
+        run."""
+        if self.bytes and not self.bytes.take(len(lines), self.deadline):
+            self.out_of_time = True
+            return False
+        if self.points and not self.points.take(lines.count("\n"),
+                                                self.deadline):
+            if self.bytes:
+                self.bytes.give(len(lines))
+            self.out_of_time = True
+            return False
+        return True
+
+    def done(self, lane, segment):
+        """Records that a lane of segment is delivered, removes the segment
+        once that was the last one."""
+        self.lock.acquire()
+        try:
+            self.left[segment.name] -= 1
+            last = not self.left[segment.name]
+        finally:
+            self.lock.release()
+        if last:
+            self.spool.remove([segment.name])
+        else:
+            # all of the lane is delivered, skip it in the next run
+            self.spool.set_offset(segment.name, segment.size, lane)
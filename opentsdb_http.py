@@ -0,0 +1,168 @@
+"""Sends spooled datapoints to the HTTP API of OpenTSDB 2.x.
+
+Lines are turned into JSON datapoints and POSTed to /api/put in batches of
+http_batch over one keep-alive connection, gzip compressed unless
+http_compress_level is 0. With ?details the TSD answers every batch with the
+number of datapoints it stored and the reason it rejected the others.
+
+Every body is sent in one piece with a Content-Length header. The TSD
+reads a body bigger than about 8 KB (compressed) in several parts, which it
+refuses with "Chunked request not supported" unless
+tsd.http.request.enable_chunked is true; keep http_batch small enough, or
+set it along with a tsd.http.request.max_chunk that fits a batch.
+"""
+import httplib
+import json
+import logging
+import re
+import socket
+import zlib
+
+LOG = logging.getLogger('opentsdb_checks.http')
+
+PUT_PATH = "/api/put?details"
+VERSION_PATH = "/api/version"
+# zlib writes a gzip header and trailer with these window bits
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+POINT = '{"metric":"%s","timestamp":%s,"value":%s,"tags":{%s}}'
+JSON_NUMBER = re.compile(r'-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?$')
+# characters that would need escaping in a JSON string
+UNSAFE = re.compile(r'["\\\x00-\x1f]')
+
+
+class HttpError(httplib.HTTPException):
+    pass
+
+
+def format_point(line):
+    """Turns a "metric ts value tag=v ..." line into a /api/put datapoint.
+
+    Well formed lines are pasted into the JSON text as they are, which is
+    several times faster than building dicts for json.dumps.
+    """
+    fields = line.split()
+    tags = fields[3:]
+    tags_json = '","'.join(tags)
+    if (not fields[1].isdigit() or not JSON_NUMBER.match(fields[2])
+        or tags_json.count("=") != len(tags) or UNSAFE.search(line)):
+        return json.dumps(parse_line(line), separators=(',', ':'))
+    if tags:
+        tags_json = '"%s"' % tags_json.replace("=", '":"')
+    return POINT % (fields[0], fields[1], fields[2], tags_json)
+
+
+def parse_line(line):
+    """Turns a "metric ts value tag=v ..." line into a /api/put datapoint."""
+    fields = line.split()
+    value = fields[2]
+    try:
+        value = int(value)
+    except ValueError:
+        value = float(value)
+    return {"metric": fields[0],
+            "timestamp": int(fields[1]),
+            "value": value,
+            "tags": dict(tag.split("=", 1) for tag in fields[3:])}
+
+
+def format_line(point):
+    """Turns a /api/put datapoint the TSD sent back into a line again."""
+    try:
+        return "%s %s %s %s" % (point["metric"], point["timestamp"],
+                                point["value"],
+                                " ".join("%s=%s" % tag
+                                         for tag in point["tags"].iteritems()))
+    except (TypeError, KeyError, AttributeError):
+        return json.dumps(point)
+
+
+class HttpSender(object):
+    """Has the same verify(), send(lines) and close() as TelnetSender."""
+
+    def __init__(self, server, timeout, batch_size, compress_level):
+        host, port = server.split(':')
+        self.server = server
+        self.batch_size = batch_size
+        self.compress_level = compress_level
+        self.batches = 0
+        # HTTP/1.1, so the socket is kept open between requests and opened
+        # again if the TSD closes it
+        self.con = httplib.HTTPConnection(host, int(port), timeout=timeout)
+
+    def request(self, method, path, body=None, headers={}):
+        """Sends a request, once more over a new connection if the TSD had
+        closed the one kept open since the last request."""
+        reused = self.con.sock is not None
+        try:
+            return self.exchange(method, path, body, headers)
+        except socket.timeout:
+            raise
+        except (httplib.BadStatusLine, socket.error), e:
+            if not reused:
+                raise
+            LOG.debug("Connection to %s went stale (%r), reconnecting"
+                      % (self.server, e))
+            self.con.close()
+            return self.exchange(method, path, body, headers)
+
+    def exchange(self, method, path, body, headers):
+        self.con.request(method, path, body, headers)
+        response = self.con.getresponse()
+        # the whole body has to be read before the connection is reused
+        return response.status, response.read()
+
+    def verify(self):
+        LOG.debug('verifying TSD %s is alive' % self.server)
+        status, reply = self.request("GET", VERSION_PATH)
+        if status != httplib.OK:
+            raise HttpError("%s answered %d to %s"
+                            % (self.server, status, VERSION_PATH))
+
+    def send(self, lines):
+        """Returns once the TSD has answered every batch of lines, with
+        (line, error) for the lines it rejected."""
+        rejected = []
+        points = []
+        for line in lines.splitlines():
+            try:
+                points.append(format_point(line))
+            except (IndexError, ValueError):
+                rejected.append((line, "not a valid datapoint"))
+                continue
+            if len(points) >= self.batch_size:
+                rejected.extend(self.post(points))
+                points = []
+        if points:
+            rejected.extend(self.post(points))
+        self.batches += 1
+        return rejected
+
+    def post(self, points):
+        body = "[" + ",".join(points) + "]"
+        headers = {"Content-Type": "application/json"}
+        if self.compress_level:
+            gzip = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                    GZIP_WBITS)
+            body = gzip.compress(body) + gzip.flush()
+            headers["Content-Encoding"] = "gzip"
+        status, reply = self.request("POST", PUT_PATH, body, headers)
+        if status in (httplib.OK, httplib.NO_CONTENT):
+            return []
+        if status == httplib.BAD_REQUEST:
+            # some datapoints were rejected, the rest is stored
+            try:
+                details = json.loads(reply)
+                failed = details["failed"]
+                errors = details.get("errors", [])
+            except (ValueError, TypeError, KeyError):
+                details = None
+            if details is not None:
+                LOG.debug("%s rejected %d of %d datapoints"
+                          % (self.server, failed, len(points)))
+                return [(format_line(error.get("datapoint")), error.get("error"))
+                        for error in errors]
+        raise HttpError("%s answered %d: %s" % (self.server, status, reply[:200]))
+
+    def close(self):
+        self.con.close()
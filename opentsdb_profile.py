@@ -0,0 +1,200 @@
+"""Profiles the phases of a run and every check, see --profile and
+--profile-memory.
+
+With --profile the checks and the send phase are run under cProfile, the
+sender threads included, and so is every in-process check on its own. The
+time of those is left out of the checks phase, which thus shows what the
+runner, the ChunkWriter and the spool cost. Python checks run as
+subprocesses are started under "python -m cProfile" (a check killed at its
+timeout leaves no profile). Each profile is written to the profile
+directory as <time>-<name>.prof, to be loaded with pstats, and its top
+functions as <time>-<name>.txt.
+
+Python 2 can't trace allocations, so --profile-memory reports what it can
+instead, as <time>-<name>.mem: for a phase or an in-process check the
+growth of the peak RSS and the objects by type it left alive; for a
+subprocess check its peak RSS, CPU time and page faults as given by
+wait4().
+"""
+import cProfile
+import errno
+import gc
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+
+# functions listed in a .txt report, types in a .mem report
+TOP = 40
+
+
+def object_counts():
+    """Objects tracked by the garbage collector, i.e. containers, by type."""
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def is_python(file):
+    if file.endswith(".py"):
+        return True
+    try:
+        f = open(file)
+        try:
+            first = f.readline(128)
+        finally:
+            f.close()
+    except IOError:
+        return False
+    return first.startswith("#!") and "python" in first
+
+
+class Profiler(object):
+
+    def __init__(self, directory, cpu=True, memory=False):
+        self.directory = directory
+        self.cpu = cpu
+        self.memory = memory
+        self.stamp = None
+        # the profile of the running phase and the ones of its threads
+        self.current = None
+        self.threads = []
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def path(self, name, suffix):
+        return os.path.join(self.directory, "%s-%s%s" % (self.stamp, name,
+                                                         suffix))
+
+    def phase(self, name, func, *args):
+        """Runs func(*args) as a phase of a run."""
+        now = time.time()
+        self.stamp = "%s.%03d" % (time.strftime("%Y%m%dT%H%M%S",
+                                                time.localtime(now)),
+                                  now * 1000 % 1000)
+        if self.memory:
+            before = (peak_rss(), object_counts())
+        if self.cpu:
+            self.current = cProfile.Profile()
+            self.threads = []
+            self.current.enable()
+        try:
+            return func(*args)
+        finally:
+            if self.cpu:
+                self.current.disable()
+                self.write_cpu(name, [self.current] + self.threads)
+                self.current = None
+            if self.memory:
+                self.write_memory(name, before)
+
+    def thread(self, target):
+        """Returns target profiled into the running phase, for threads."""
+        if not self.current:
+            return target
+
+        def profiled(*args):
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(target, *args)
+            finally:
+                self.lock.acquire()
+                try:
+                    self.threads.append(profile)
+                finally:
+                    self.lock.release()
+        return profiled
+
+    def check(self, file, func, *args):
+        """Runs in-process check file as func(*args), profiled on its own."""
+        name = "check-" + os.path.basename(file)
+        if self.memory:
+            before = (peak_rss(), object_counts())
+        try:
+            if not self.cpu:
+                return func(*args)
+            # only one profiler can be enabled at a time
+            if self.current:
+                self.current.disable()
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                self.write_cpu(name, [profile])
+                if self.current:
+                    self.current.enable()
+        finally:
+            if self.memory:
+                self.write_memory(name, before)
+
+    def command(self, file, args):
+        """Returns the command line to run subprocess check file with."""
+        if self.cpu and is_python(file):
+            return [sys.executable, "-m", "cProfile", "-o",
+                    self.path("check-" + os.path.basename(file), ".prof"),
+                    file] + args
+        return [file] + args
+
+    def finished(self, file, rusage):
+        """Writes the reports of subprocess check file, which has exited
+        with rusage."""
+        name = "check-" + os.path.basename(file)
+        if self.cpu and os.path.exists(self.path(name, ".prof")):
+            self.write_top(name, pstats.Stats(self.path(name, ".prof")))
+        if self.memory:
+            f = open(self.path(name, ".mem"), 'w')
+            try:
+                f.write("peak RSS %d KB\n" % rusage.ru_maxrss)
+                f.write("CPU %.3f s user, %.3f s system\n"
+                        % (rusage.ru_utime, rusage.ru_stime))
+                f.write("page faults %d minor, %d major\n"
+                        % (rusage.ru_minflt, rusage.ru_majflt))
+            finally:
+                f.close()
+
+    def write_cpu(self, name, profiles):
+        profiles = [profile for profile in profiles if profile.getstats()]
+        if not profiles:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(self.path(name, ".prof"))
+        self.write_top(name, stats)
+
+    def write_top(self, name, stats):
+        f = open(self.path(name, ".txt"), 'w')
+        try:
+            stats.stream = f
+            stats.sort_stats("cumulative").print_stats(TOP)
+        finally:
+            f.close()
+
+    def write_memory(self, name, before):
+        rss, counts = before
+        after = object_counts()
+        growth = [(after.get(kind, 0) - counts.get(kind, 0), kind)
+                  for kind in set(after) | set(counts)]
+        growth.sort(reverse=True)
+        f = open(self.path(name, ".mem"), 'w')
+        try:
+            f.write("peak RSS %d KB (+%d KB)\n" % (peak_rss(), peak_rss() - rss))
+            f.write("objects left alive, by type (containers only):\n")
+            for change, kind in growth[:TOP]:
+                if change <= 0:
+                    break
+                f.write("%10d  %s\n" % (change, kind))
+        finally:
+            f.close()
@@ -0,0 +1,640 @@
+"""Append-only segment spool for datapoints waiting to be sent to the TSD.
+
+Checks append blocks of lines to cachedir/active.seg. Once it grows past
+segment_size or segment_age, or right before it is sent, the active segment
+is sealed: renamed to <first write ts>-<random>.seg and listed with its time
+range in spool.idx. The sender keeps the offset it has delivered up to for
+each segment (or each lane of a segment, see opentsdb_drain) in
+spool.ckpt. Retention, max_chunks (a number of segments) and
+max_spool_bytes only look at the index and touch the segments they expire,
+the cache dir is never listed or sorted (unless the index has to be
+rebuilt).
+
+A segment is a sequence of blocks, each one prefixed by a header holding its
+kind, write time, payload length and the crc32 of the payload. With a non
+zero compress_level, blocks of lines are stored zlib compressed and inflated
+one at a time while they are sent.
+
+With the dict spool format, every distinct metric and tag set ("series") is
+written once per segment in a series block, and datapoints are stored as
+columns of series ids, timestamps and values which are expanded back to
+lines when read. Series blocks can be found by skipping over the others, so
+a writer picks up the series another process added to the active segment
+without decoding any datapoints.
+
+Lines the TSD refused are appended to cachedir/quarantine with the reason,
+so they are kept for a look but never sent again.
+"""
+import array
+import errno
+import fcntl
+import itertools
+import logging
+import os
+import random
+import re
+import struct
+import sys
+import time
+import zlib
+
+LOG = logging.getLogger('opentsdb_checks.spool')
+
+BLOCK_SIZE = 64 * 1024
+
+ACTIVE = "active.seg"
+INDEX = "spool.idx"
+CHECKPOINT = "spool.ckpt"
+# separates segment name and lane in checkpoint keys
+LANE_SEPARATOR = ":"
+LOCK = "spool.lock"
+# held by the process draining the spool, see lock_send
+SEND_LOCK = "send.lock"
+SEGMENT_SUFFIX = ".seg"
+QUARANTINE = "quarantine"
+# rotated to quarantine.1 beyond this size
+QUARANTINE_SIZE = 16 * 1024 * 1024
+
+BLOCK_HEADER = struct.Struct(">cIII")
+TEXT_BLOCK = "T"
+ZLIB_BLOCK = "Z"
+SERIES_BLOCK = "S"
+ZLIB_SERIES_BLOCK = "R"
+DICT_BLOCK = "D"
+ZLIB_DICT_BLOCK = "E"
+COMPRESSED = {
+    TEXT_BLOCK: ZLIB_BLOCK,
+    SERIES_BLOCK: ZLIB_SERIES_BLOCK,
+    DICT_BLOCK: ZLIB_DICT_BLOCK,
+}
+INFLATED = dict((v, k) for k, v in COMPRESSED.iteritems())
+SERIES_KINDS = (SERIES_BLOCK, ZLIB_SERIES_BLOCK)
+
+TEXT_FORMAT = "text"
+DICT_FORMAT = "dict"
+
+# dict blocks are column oriented: the number of datapoints, their series
+# ids and timestamps as little endian 32 bit arrays, then the values joined
+# by newlines
+COUNT = struct.Struct("<I")
+ARRAY_TYPE = [t for t in "IL" if array.array(t).itemsize == 4][0]
+# lines we can't split into series, timestamp and value are kept as is
+RAW_SERIES = 0xffffffff
+
+# one file per check run, written before the segment spool existed
+legacy_chunk = re.compile('^[0-9]+(\.[0-9]+)?-[0-9]+$')
+
+
+class Segment(object):
+    def __init__(self, name, min_ts, max_ts, size):
+        self.name = name
+        self.min_ts = min_ts
+        self.max_ts = max_ts
+        self.size = size
+
+    def __str__(self):
+        return "%s %d %d %d" % (self.name, self.min_ts, self.max_ts, self.size)
+
+
+def inflate(kind, payload):
+    if kind in INFLATED:
+        return INFLATED[kind], zlib.decompress(payload)
+    return kind, payload
+
+
+def encode_lines(lines, series):
+    """Encodes newline terminated lines into a dict block payload.
+
+    series maps "metric tags" to ids and gets the new series added, which
+    are returned along with the payload in order of their ids.
+    """
+    ids = array.array(ARRAY_TYPE)
+    stamps = array.array(ARRAY_TYPE)
+    values = []
+    new_series = []
+    # bound once, this loop runs for every datapoint
+    add_id, add_ts, add_value = ids.append, stamps.append, values.append
+    get_id = series.get
+    for line in lines.splitlines():
+        fields = line.split(None, 3)
+        try:
+            ts = int(fields[1])
+            value = fields[2]
+            if not 0 <= ts < RAW_SERIES:
+                raise ValueError
+        except (IndexError, ValueError):
+            add_id(RAW_SERIES)
+            add_ts(0)
+            add_value(line)
+            continue
+        if len(fields) == 4:
+            key = fields[0] + " " + fields[3]
+        else:
+            key = fields[0]
+        id = get_id(key)
+        if id is None:
+            id = series[key] = len(series)
+            new_series.append(key)
+        add_id(id)
+        add_ts(ts)
+        add_value(value)
+    if sys.byteorder == "big":
+        ids.byteswap()
+        stamps.byteswap()
+    return new_series, (COUNT.pack(len(ids)) + ids.tostring()
+                        + stamps.tostring() + "\n".join(values))
+
+
+def decode_lines(payload, series):
+    """Expands a dict block payload back to newline terminated lines.
+
+    series is the list of (metric + " ", " " + tags + "\\n") for each id.
+    """
+    count = COUNT.unpack_from(payload)[0]
+    pos = COUNT.size
+    ids = array.array(ARRAY_TYPE, payload[pos:pos + 4 * count])
+    pos += 4 * count
+    stamps = array.array(ARRAY_TYPE, payload[pos:pos + 4 * count])
+    pos += 4 * count
+    if sys.byteorder == "big":
+        ids.byteswap()
+        stamps.byteswap()
+    lines = []
+    for id, ts, value in itertools.izip(ids, stamps, payload[pos:].split("\n")):
+        if id == RAW_SERIES:
+            lines.append(value + "\n")
+        else:
+            prefix, suffix = series[id]
+            lines.append("%s%d %s%s" % (prefix, ts, value, suffix))
+    return "".join(lines)
+
+
+def split_series(key):
+    if " " in key:
+        metric, tags = key.split(" ", 1)
+        return metric + " ", " " + tags + "\n"
+    return key + " ", "\n"
+
+
+def read_blocks(path, offset=0, kinds=None, end=None):
+    """Yields (offset after block, kind, payload) for each complete block
+    from offset (up to end), payloads of blocks not in kinds are skipped."""
+    f = open(path, 'rb')
+    try:
+        f.seek(offset)
+        while end is None or offset < end:
+            header = f.read(BLOCK_HEADER.size)
+            if not header:
+                break
+            if len(header) < BLOCK_HEADER.size:
+                LOG.error("Truncated block header in %s at %d" % (path, offset))
+                break
+            kind, ts, length, crc = BLOCK_HEADER.unpack(header)
+            if kinds is not None and kind not in kinds:
+                f.seek(length, os.SEEK_CUR)
+                offset += BLOCK_HEADER.size + length
+                continue
+            payload = f.read(length)
+            if len(payload) < length \
+                    or zlib.crc32(payload) & 0xffffffff != crc:
+                LOG.error("Corrupt block in %s at %d, skipping the rest"
+                          % (path, offset))
+                break
+            offset += BLOCK_HEADER.size + length
+            yield offset, kind, payload
+    finally:
+        f.close()
+
+
+class Spool(object):
+    def __init__(self, cache_dir, segment_size, segment_age, compress_level=0,
+                 spool_format=TEXT_FORMAT):
+        if spool_format not in (TEXT_FORMAT, DICT_FORMAT):
+            raise ValueError("Unknown spool format %r" % spool_format)
+        self.cache_dir = cache_dir
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.compress_level = compress_level
+        self.spool_format = spool_format
+        self.fd = None
+        # series of the active segment we know about, see sync_series
+        self.series = {}
+        self.series_ino = None
+        self.series_offset = 0
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def lock(self):
+        f = open(self.path(LOCK), 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def lock_send(self):
+        """Returns the send lock, or None if another process (a cron run
+        next to a daemon, or a slow cron run) holds it: two drains of the
+        same segments would send them twice. Release it with unlock()."""
+        f = open(self.path(SEND_LOCK), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            f.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        return f
+
+    def unlock(self, f):
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+    def open_active(self):
+        """Returns our fd of the active segment, exclusively flocked.
+
+        Another process may have sealed (renamed) the segment we had open,
+        in which case a new one is created.
+        """
+        path = self.path(ACTIVE)
+        while True:
+            if self.fd is None:
+                self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                  0644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino == os.fstat(self.fd).st_ino:
+                    return self.fd
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def block(self, kind, payload):
+        if self.compress_level:
+            payload = zlib.compress(payload, self.compress_level)
+            kind = COMPRESSED[kind]
+        return BLOCK_HEADER.pack(kind, int(time.time()), len(payload),
+                                 zlib.crc32(payload) & 0xffffffff) + payload
+
+    def append(self, lines):
+        """Appends a block of newline terminated lines to the active
+        segment, without fsync."""
+        fd = self.open_active()
+        try:
+            if self.spool_format == DICT_FORMAT:
+                new_series, payload = encode_lines(lines, self.sync_series(fd))
+                data = self.block(DICT_BLOCK, payload)
+                if new_series:
+                    data = self.block(SERIES_BLOCK,
+                                      "".join(key + "\n" for key in new_series)) + data
+            else:
+                data = self.block(TEXT_BLOCK, lines)
+            while data:
+                data = data[os.write(fd, data):]
+            if self.spool_format == DICT_FORMAT:
+                self.series_offset = os.fstat(fd).st_size
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def sync_series(self, fd):
+        """Returns the series of the active segment, including the ones
+        other processes added since we last looked. Needs fd flocked."""
+        ino = os.fstat(fd).st_ino
+        if ino != self.series_ino:
+            self.series = {}
+            self.series_ino = ino
+            self.series_offset = 0
+        for offset, kind, payload in read_blocks(self.path(ACTIVE),
+                                                 self.series_offset,
+                                                 SERIES_KINDS):
+            for key in inflate(kind, payload)[1].splitlines():
+                self.series[key] = len(self.series)
+        self.series_offset = os.fstat(fd).st_size
+        return self.series
+
+    def commit(self):
+        """Group commit: one fsync for everything appended since the last
+        one, then seals the active segment if it's too big or too old."""
+        if self.fd is None:
+            return
+        os.fsync(self.fd)
+        size = os.fstat(self.fd).st_size
+        os.close(self.fd)
+        self.fd = None
+        if size >= self.segment_size:
+            self.seal()
+        elif size > 0 and self.active_since() < time.time() - self.segment_age:
+            self.seal()
+
+    def active_since(self):
+        """Write time of the first block of the active segment, now if it
+        has none (or was just sealed by another process)."""
+        try:
+            f = open(self.path(ACTIVE), 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return time.time()
+        try:
+            header = f.read(BLOCK_HEADER.size)
+        finally:
+            f.close()
+        if len(header) < BLOCK_HEADER.size:
+            return time.time()
+        return BLOCK_HEADER.unpack(header)[1]
+
+    def seal(self):
+        """Turns the active segment into a sealed one.
+
+        Returns False if there was nothing to seal.
+        """
+        lock = self.lock()
+        try:
+            # makes sure the index exists before the entry is appended
+            self.read_index()
+            path = self.path(ACTIVE)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    return False
+                raise
+            try:
+                # waits for writers in the middle of a block
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                size = os.fstat(fd).st_size
+                header = os.read(fd, BLOCK_HEADER.size)
+                if len(header) < BLOCK_HEADER.size:
+                    return False
+                min_ts = BLOCK_HEADER.unpack(header)[1]
+                segment = Segment("%d-%08x%s" % (min_ts, random.getrandbits(32),
+                                                 SEGMENT_SUFFIX),
+                                  min_ts, int(time.time()), size)
+                os.fsync(fd)
+                # index first: an entry without a file is simply dropped,
+                # but a file without an entry would never be sent nor
+                # expired, so both have to be on disk before the rename is
+                index = open(self.path(INDEX), 'a')
+                try:
+                    index.write(str(segment) + "\n")
+                    index.flush()
+                    os.fsync(index.fileno())
+                finally:
+                    index.close()
+                os.rename(path, self.path(segment.name))
+                fsync_dir(self.cache_dir)
+            finally:
+                os.close(fd)
+            LOG.debug("Sealed segment %s" % segment)
+            return True
+        finally:
+            self.unlock(lock)
+
+    def empty(self):
+        try:
+            if os.stat(self.path(ACTIVE)).st_size > 0:
+                return False
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        return not self.segments()
+
+    def segments(self):
+        """Sealed segments, oldest first."""
+        lock = self.lock()
+        try:
+            return self.read_index()
+        finally:
+            self.unlock(lock)
+
+    def usage(self):
+        """Returns the number of sealed segments and the bytes of all
+        segments, the active one included."""
+        segments = self.segments()
+        size = sum(segment.size for segment in segments)
+        try:
+            size += os.stat(self.path(ACTIVE)).st_size
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        return len(segments), size
+
+    def read_index(self):
+        try:
+            f = open(self.path(INDEX))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return self.rebuild_index()
+        segments = []
+        try:
+            for line in f:
+                try:
+                    name, min_ts, max_ts, size = line.split()
+                    segments.append(Segment(name, int(min_ts), int(max_ts),
+                                            int(size)))
+                except ValueError:
+                    LOG.error("Bad spool index line: %r" % line)
+        finally:
+            f.close()
+        segments.sort(key=lambda s: (s.min_ts, s.name))
+        return segments
+
+    def write_index(self, segments):
+        write_atomically(self.path(INDEX),
+                         "".join(str(s) + "\n" for s in segments))
+
+    def rebuild_index(self):
+        """Lists the cache dir to find sealed segments missing from the
+        index, moving chunks from older versions into the active segment."""
+        segments = []
+        legacy = []
+        for fname in sorted(os.listdir(self.cache_dir)):
+            path = self.path(fname)
+            if fname.endswith(SEGMENT_SUFFIX) and fname != ACTIVE:
+                st = os.stat(path)
+                segments.append(Segment(fname, int(fname.split('-')[0]),
+                                        int(st.st_mtime), st.st_size))
+            elif legacy_chunk.match(fname):
+                legacy.append(path)
+            elif fname.endswith(".part"):
+                os.unlink(path)
+        # a new cache dir has nothing to rebuild from, no need to worry anyone
+        if segments or legacy:
+            LOG.warning("Rebuilt spool index in %s: %d segments, %d old chunks"
+                        % (self.cache_dir, len(segments), len(legacy)))
+        else:
+            LOG.debug("Created spool index in %s" % self.cache_dir)
+        self.write_index(segments)
+        for path in legacy:
+            f = open(path)
+            try:
+                while True:
+                    payload = f.read(BLOCK_SIZE)
+                    if not payload:
+                        break
+                    payload += f.readline()
+                    if not payload.endswith("\n"):
+                        payload += "\n"
+                    self.append(payload)
+            finally:
+                f.close()
+            os.unlink(path)
+        return segments
+
+    def read_checkpoint(self):
+        offsets = {}
+        try:
+            f = open(self.path(CHECKPOINT))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return offsets
+        try:
+            for line in f:
+                try:
+                    name, offset = line.split()
+                    offsets[name] = int(offset)
+                except ValueError:
+                    LOG.error("Bad spool checkpoint line: %r" % line)
+        finally:
+            f.close()
+        return offsets
+
+    def write_checkpoint(self, offsets):
+        write_atomically(self.path(CHECKPOINT),
+                         "".join("%s %d\n" % item for item in offsets.iteritems()))
+
+    def offset(self, name, lane=None):
+        """Offset the segment (or a lane of it) has been delivered up to."""
+        lock = self.lock()
+        try:
+            return self.read_checkpoint().get(checkpoint_key(name, lane), 0)
+        finally:
+            self.unlock(lock)
+
+    def set_offset(self, name, offset, lane=None):
+        lock = self.lock()
+        try:
+            offsets = self.read_checkpoint()
+            offsets[checkpoint_key(name, lane)] = offset
+            self.write_checkpoint(offsets)
+        finally:
+            self.unlock(lock)
+
+    def remove(self, names):
+        """Drops segments (delivered or expired) from disk and index."""
+        names = set(names)
+        if not names:
+            return
+        lock = self.lock()
+        try:
+            for name in names:
+                try:
+                    os.unlink(self.path(name))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            self.write_index([s for s in self.read_index()
+                              if s.name not in names])
+            offsets = self.read_checkpoint()
+            delivered = [key for key in offsets
+                         if key.split(LANE_SEPARATOR, 1)[0] in names]
+            if delivered:
+                for key in delivered:
+                    del offsets[key]
+                self.write_checkpoint(offsets)
+        finally:
+            self.unlock(lock)
+
+    def expire(self, min_timestamp, max_segments, max_bytes=0):
+        """Drops segments older than min_timestamp, then the oldest ones
+        above max_segments or max_bytes (0 for no limit) of sealed segments.
+        Only the index is read."""
+        segments = self.segments()
+        expired = [s.name for s in segments if s.max_ts < min_timestamp]
+        kept = [s for s in segments if s.max_ts >= min_timestamp]
+        overflow = len(kept) - max_segments
+        if overflow > 0:
+            expired += [s.name for s in kept[:overflow]]
+            kept = kept[overflow:]
+        if max_bytes:
+            size = sum(s.size for s in kept)
+            for segment in kept:
+                if size <= max_bytes:
+                    break
+                expired.append(segment.name)
+                size -= segment.size
+        if expired:
+            LOG.debug("Removing %d expired segments" % len(expired))
+            self.remove(expired)
+
+    def quarantine(self, rejected):
+        """Appends (line, reason) pairs to the quarantine file."""
+        data = "".join("%s\t# %s\n" % item for item in rejected)
+        path = self.path(QUARANTINE)
+        lock = self.lock()
+        try:
+            try:
+                if os.path.getsize(path) >= QUARANTINE_SIZE:
+                    os.rename(path, path + ".1")
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            f = open(path, 'a')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+        finally:
+            self.unlock(lock)
+
+    def read(self, name, offset=0):
+        """Yields (offset after block, newline terminated lines) for the
+        blocks of a sealed segment starting at offset."""
+        path = self.path(name)
+        series = []
+        if offset:
+            # series defined before the offset we resume from
+            for _, kind, payload in read_blocks(path, 0, SERIES_KINDS, offset):
+                series.extend(map(split_series,
+                                  inflate(kind, payload)[1].splitlines()))
+        for offset, kind, payload in read_blocks(path, offset):
+            kind, payload = inflate(kind, payload)
+            if kind == TEXT_BLOCK:
+                yield offset, payload
+            elif kind == DICT_BLOCK:
+                yield offset, decode_lines(payload, series)
+            elif kind == SERIES_BLOCK:
+                series.extend(map(split_series, payload.splitlines()))
+            else:
+                LOG.error("Unknown block kind %r in %s" % (kind, name))
+
+
+def checkpoint_key(name, lane):
+    if lane is None:
+        return name
+    return "%s%s%d" % (name, LANE_SEPARATOR, lane)
+
+
+def write_atomically(path, data):
+    tmp = path + ".tmp"
+    f = open(tmp, 'w')
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp, path)
+    fsync_dir(os.path.dirname(path) or ".")
+
+
+def fsync_dir(path):
+    """Makes the renames in directory path durable."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
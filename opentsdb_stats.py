@@ -0,0 +1,90 @@
+"""Datapoints the collector reports about itself.
+
+Both the checks and the sending of a run spool opentsdb_checks.* datapoints
+next to the ones of the checks (send statistics go out with the next run),
+so the health of the pipeline can be graphed from the same TSD:
+
+    check.duration       seconds a check ran, tagged with check
+    check.exit_status    its exit status, -9 when it was killed
+    check.timed_out      1 if it was killed at the timeout, else 0
+    check.lines          lines it wrote to the spool
+    check.bytes          bytes it wrote to the spool
+    check.rejected       lines it printed that the TSD would refuse
+    spool.segments       sealed segments waiting to be sent
+    spool.bytes          bytes in the spool, the active segment included
+    send.duration        seconds the drain took
+    send.lines           datapoints sent, the rejected ones included
+    send.bytes           bytes of them
+    send.bytes_per_second
+    send.rejected        lines the TSDs refused, see the quarantine
+    send.connect_time    seconds to connect to and verify a TSD, tagged with
+                         tsd and port
+    send.connect_errors  failed attempts to do that
+    send.oldest_age      seconds since the oldest segment was started, i.e.
+                         how far behind the TSD is
+    send.newest_age      seconds since the newest segment was sealed
+
+Set self_metrics to false to turn them off.
+"""
+import threading
+import time
+
+PREFIX = "opentsdb_checks."
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return "%.3f" % value
+    return "%d" % value
+
+
+def format_tags(tags):
+    return "".join(" %s=%s" % tag for tag in sorted(tags.iteritems()))
+
+
+class Stats(object):
+    """Collects the datapoints until they are spooled; shared by the
+    sender threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.points = []
+        self.counters = {}
+
+    def add(self, metric, value, **tags):
+        line = "%s%s %d %s%s" % (PREFIX, metric, int(time.time()),
+                                 format_value(value), format_tags(tags))
+        self.lock.acquire()
+        try:
+            self.points.append(line)
+        finally:
+            self.lock.release()
+
+    def count(self, metric, amount=1, **tags):
+        """Adds amount to a counter, written once with the total."""
+        key = metric + format_tags(tags)
+        self.lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        finally:
+            self.lock.release()
+
+    def get(self, metric, **tags):
+        return self.counters.get(metric + format_tags(tags), 0)
+
+    def lines(self):
+        """Returns the datapoints as lines and starts over."""
+        self.lock.acquire()
+        try:
+            lines = self.points
+            now = int(time.time())
+            for key, total in self.counters.iteritems():
+                metric, _, tags = key.partition(" ")
+                lines.append("%s%s %d %s%s" % (PREFIX, metric, now,
+                                               format_value(total),
+                                               tags and " " + tags))
+            self.points = []
+            self.counters = {}
+        finally:
+            self.lock.release()
+        return lines
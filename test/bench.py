@@ -0,0 +1,207 @@
+#!/usr/bin/python
+"""Benchmarks the collector end to end against test/fake_tsd.py.
+
+Usage: bench.py [options] [key=value ...]
+
+Generates checks printing lines, then for every round runs call_checks and
+send_outstanding of opentsdb_checks against a fake TSD on localhost, and
+reports checks and lines per second, spool bytes, drain time and peak RSS.
+The key=value pairs set options of the Main section, e.g. compress_level=0,
+spool_format=dict or transport=http (which also makes the fake TSD speak
+HTTP).
+"""
+
+from optparse import OptionParser
+import logging
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+import opentsdb_checks
+
+FAKE_TSD = os.path.join(BASE_DIR, "test", "fake_tsd.py")
+
+CHECK = '''#!%(python)s
+import sys
+import time
+
+
+def collect(confs_dir=None):
+    ts = int(time.time())
+    for i in xrange(%(lines)d):
+        yield ("bench.metric%%d" %% (i %% %(metrics)d), ts, %(value)s,
+               "check=%(name)s series=%%d" %% (i %% %(series)d))
+
+
+def main():
+    for metric, ts, value, tags in collect():
+        print metric, ts, value, tags
+
+if __name__ == "__main__":
+    main()
+'''
+
+
+def parse_cmdline(argv):
+    parser = OptionParser(description="End to end benchmark of the collector.",
+                          usage="%prog [options] [key=value ...]")
+    parser.add_option('-n', '--checks', type='int', default=10,
+                      help='Number of checks (default %default).')
+    parser.add_option('-l', '--lines', type='int', default=10000,
+                      help='Lines printed by each check (default %default).')
+    parser.add_option('-m', '--metrics', type='int', default=10,
+                      help='Metrics of each check (default %default).')
+    parser.add_option('-s', '--series', type='int', default=100,
+                      help='Series (tag sets) of each check (default %default).')
+    parser.add_option('-c', '--constant', action='store_true', default=False,
+                      help='Print the same value every round.')
+    parser.add_option('-r', '--rounds', type='int', default=3,
+                      help='Rounds to run (default %default).')
+    parser.add_option('--latency', type='float', default=0,
+                      help='Seconds the fake TSD waits before answering.')
+    parser.add_option('--drop', type='float', default=0,
+                      help='Fraction of datapoints the fake TSD loses.')
+    parser.add_option('--disconnect', type='int', default=0,
+                      help='Datapoints after which the fake TSD hangs up.')
+    parser.add_option('-v', action='store_true', default=False, dest='verbose',
+                      help='Show the collector log.')
+    return parser.parse_args(args=argv[1:])
+
+
+def make_checks(checks_dir, options):
+    os.mkdir(checks_dir)
+    for i in range(options.checks):
+        name = "bench%03d.py" % i
+        path = os.path.join(checks_dir, name)
+        f = open(path, 'w')
+        try:
+            f.write(CHECK % {"python": sys.executable,
+                             "lines": options.lines,
+                             "metrics": options.metrics,
+                             "series": options.series,
+                             "value": options.constant and "1" or "i",
+                             "name": name})
+        finally:
+            f.close()
+        os.chmod(path, 0755)
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_tsd(port, received, options, http):
+    args = [sys.executable, FAKE_TSD, "-o", received,
+            "-l", str(options.latency), "-d", str(options.drop),
+            "-c", str(options.disconnect)]
+    if http:
+        args.append("-H")
+    tsd = subprocess.Popen(args + [str(port)])
+    for i in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return tsd
+        except socket.error:
+            time.sleep(0.1)
+    tsd.kill()
+    raise RuntimeError("fake TSD didn't come up on port %d" % port)
+
+
+def write_config(path, settings):
+    f = open(path, 'w')
+    try:
+        f.write("[%s]\n" % opentsdb_checks.MAIN_SECTION)
+        for item in settings:
+            f.write("%s=%s\n" % item)
+    finally:
+        f.close()
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path))
+
+
+def count_lines(path):
+    f = open(path)
+    try:
+        return sum(1 for line in f)
+    finally:
+        f.close()
+
+
+def main(argv):
+    options, overrides = parse_cmdline(argv)
+    logging.basicConfig(level=options.verbose and logging.DEBUG or logging.ERROR)
+    workdir = tempfile.mkdtemp(prefix="opentsdb-bench-")
+    tsd = None
+    try:
+        checks_dir = os.path.join(workdir, "checks")
+        cache_dir = os.path.join(workdir, "cache")
+        received = os.path.join(workdir, "received")
+        make_checks(checks_dir, options)
+        open(received, 'w').close()
+        port = free_port()
+        settings = [(opentsdb_checks.CHECKSDIR_KEY, checks_dir),
+                    (opentsdb_checks.CACHEDIR_KEY, cache_dir),
+                    (opentsdb_checks.HOSTS_KEY, "localhost:%d" % port),
+                    # only count what the checks printed
+                    (opentsdb_checks.SELF_METRICS_KEY, "false")]
+        settings.extend(tuple(override.split("=", 1)) for override in overrides)
+        config_file = os.path.join(workdir, "bench.conf")
+        write_config(config_file, settings)
+        opentsdb_checks.default_config = os.path.join(BASE_DIR,
+                                                      'opentsdb_checks.defaults')
+        config = opentsdb_checks.read_config(config_file)
+        opentsdb_checks.init_caches(config)
+        http = (config.get(opentsdb_checks.MAIN_SECTION,
+                           opentsdb_checks.TRANSPORT_KEY)
+                == opentsdb_checks.HTTP_TRANSPORT)
+        tsd = start_tsd(port, received, options, http)
+        checks = set(os.listdir(checks_dir))
+        lines = options.checks * options.lines
+
+        print "%d checks x %d lines, %s" % (options.checks, options.lines,
+                                            " ".join(overrides) or "defaults")
+        print "%5s %9s %10s %12s %8s %10s %9s" % (
+            "round", "checks/s", "lines/s", "spool bytes", "drain s",
+            "sent/s", "received")
+        total = 0
+        for round in range(options.rounds):
+            start = time.time()
+            opentsdb_checks.call_checks(checks, config)
+            checked = time.time()
+            spooled = dir_size(cache_dir)
+            opentsdb_checks.send_outstanding(config)
+            drained = time.time()
+            seen = count_lines(received)
+            print "%5d %9.1f %10.0f %12d %8.2f %10.0f %9d" % (
+                round + 1, options.checks / (checked - start),
+                lines / (checked - start), spooled, drained - checked,
+                (seen - total) / (drained - checked), seen - total)
+            total = seen
+
+        collector = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        checks = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print "peak RSS: collector %.1f MB, checks %.1f MB" % (
+            collector / 1024.0, checks / 1024.0)
+        print "received %d of %d lines" % (total, lines * options.rounds)
+    finally:
+        if tsd:
+            tsd.terminate()
+            tsd.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main(sys.argv)
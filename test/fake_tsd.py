@@ -0,0 +1,177 @@
+#!/usr/bin/python
+"""Stand-in TSD for trying out the senders without an OpenTSDB cluster.
+
+Usage: fake_tsd.py [-H] [-o file] [-l latency] [-d drop] [-c puts] port
+
+Speaks the telnet style put protocol, or with -H the /api/put and
+/api/version HTTP endpoints of OpenTSDB 2.x (gzip bodies, keep-alive and
+?details included). Accepted datapoints are written to file (stdout by
+default) as put lines. Datapoints whose metric contains "BAD" or which
+have no tags are rejected like the real TSD would.
+
+To see how the sender copes with a struggling TSD, -l waits latency seconds
+before every answer, -d silently loses the given fraction of datapoints and
+-c drops the connection after every that many datapoints.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import getopt
+import json
+import random
+import sys
+import threading
+import time
+import zlib
+
+VERSION = ("net.opentsdb built at revision 0 (MODIFIED)\n"
+           "Built on 2013/01/01 00:00:00 +0000 by fake@localhost:/fake\n")
+
+out = sys.stdout
+out_lock = threading.Lock()
+latency = 0
+drop = 0
+disconnect = 0
+
+
+def write(lines):
+    out_lock.acquire()
+    try:
+        out.write("".join(lines))
+        out.flush()
+    finally:
+        out_lock.release()
+
+
+def check(metric, tags):
+    if "BAD" in metric:
+        return "Invalid metric name (\"%s\")" % metric
+    if not tags:
+        return "Need at least one tag"
+
+
+def lost():
+    return drop and random.random() < drop
+
+
+class TelnetHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        accepted = []
+        puts = 0
+        for line in self.rfile:
+            if line.startswith("version"):
+                write(accepted)
+                accepted = []
+                if latency:
+                    time.sleep(latency)
+                self.wfile.write(VERSION)
+            elif line.startswith("put "):
+                puts += 1
+                if disconnect and puts > disconnect:
+                    break
+                if lost():
+                    continue
+                fields = line.split()
+                error = check(fields[1], fields[4:])
+                if error:
+                    self.wfile.write("put: illegal argument: %s\n" % error)
+                else:
+                    accepted.append(line)
+        write(accepted)
+
+
+class HttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # one write per reply, unbuffered header lines stall on delayed acks
+    wbufsize = -1
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if latency:
+            time.sleep(latency)
+        if self.path.startswith("/api/version"):
+            self.reply(200, json.dumps({"version": "2.0.0-fake"}))
+        else:
+            self.reply(404, json.dumps({"error": {"code": 404}}))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if not self.path.startswith("/api/put"):
+            return self.reply(404, json.dumps({"error": {"code": 404}}))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        points = json.loads(body)
+        if isinstance(points, dict):
+            points = [points]
+        self.puts = getattr(self, "puts", 0) + len(points)
+        if disconnect and self.puts > disconnect:
+            # hang up without an answer
+            self.close_connection = 1
+            return
+        if latency:
+            time.sleep(latency)
+        accepted, errors = [], []
+        for point in points:
+            if lost():
+                continue
+            error = check(point["metric"], point.get("tags"))
+            if error:
+                errors.append({"datapoint": point, "error": error})
+                continue
+            tags = " ".join("%s=%s" % tag for tag in sorted(point["tags"].items()))
+            accepted.append("put %s %d %s %s\n" % (point["metric"],
+                                                   point["timestamp"],
+                                                   point["value"], tags))
+        write(accepted)
+        if "details" not in self.path:
+            if errors:
+                self.reply(400, json.dumps({"error": {"code": 400}}))
+            else:
+                self.send_response(204)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            return
+        self.reply(errors and 400 or 200,
+                   json.dumps({"success": len(accepted),
+                               "failed": len(errors),
+                               "errors": errors}))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ThreadingTelnetServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main(argv):
+    global out, latency, drop, disconnect
+    optlist, args = getopt.getopt(argv[1:], 'Ho:l:d:c:')
+    opts = dict(optlist)
+    if '-o' in opts:
+        out = open(opts['-o'], 'a')
+    latency = float(opts.get('-l', 0))
+    drop = float(opts.get('-d', 0))
+    disconnect = int(opts.get('-c', 0))
+    if '-H' in opts:
+        server = ThreadingHTTPServer(("", int(args[0])), HttpHandler)
+    else:
+        server = ThreadingTelnetServer(("", int(args[0])), TelnetHandler)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+"""Tries out the rollups of opentsdb_aggregate.
+
+Usage: verify_aggregate.py
+
+Checks what Aggregator makes of datapoints for sum, min, max and count
+rules, with and without "by" tags and "keep", and that a check's output
+spooled through opentsdb_checks.ChunkWriter gets the rollups in place of
+the raw series. Prints the name of every test that passed; a failure
+raises AssertionError.
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+import opentsdb_aggregate
+import opentsdb_checks
+import opentsdb_datapoint
+import opentsdb_spool
+
+T = 1000000000
+TCP = [("proc.net.tcp", T, "1", "state=established port=80"),
+       ("proc.net.tcp", T, "2", "state=established port=443"),
+       ("proc.net.tcp", T, "4", "state=time_wait port=80"),
+       ("proc.net.tcp", T + 10, "8", "state=established port=80")]
+
+
+def rollup(rules, points):
+    """Returns the lines written for points and the rollups, sorted."""
+    aggregator = opentsdb_aggregate.Aggregator(opentsdb_aggregate.Rules(rules))
+    lines = []
+    for metric, ts, value, tags in points:
+        point = opentsdb_datapoint.Datapoint(metric, ts, value, tags)
+        if aggregator.add(point):
+            lines.append(point.line())
+    lines.extend(point.line() for point in aggregator.points())
+    return sorted(lines)
+
+
+def test_sum_by(cache_dir):
+    assert rollup([("tcp", "proc.net.tcp sum by state")], TCP) == [
+        "proc.net.tcp %d 3 state=established\n" % T,
+        "proc.net.tcp %d 4 state=time_wait\n" % T,
+        "proc.net.tcp %d 8 state=established\n" % (T + 10)]
+
+
+def test_functions(cache_dir):
+    for function, values in (("min", (1, 8)), ("max", (4, 8)),
+                             ("count", (3, 1))):
+        assert rollup([("tcp", "proc.net.tcp %s by" % function)], TCP) == [
+            "proc.net.tcp %d %d\n" % (T, values[0]),
+            "proc.net.tcp %d %d\n" % (T + 10, values[1])], function
+
+
+def test_several_tags_and_floats(cache_dir):
+    points = [("m", T, "0.5", "a=1 b=1 c=1"), ("m", T, "0.25", "b=1 a=1 c=2"),
+              ("m", T, "1e3", "a=2 b=1")]
+    assert rollup([("m", "m sum by a,b")], points) == [
+        "m %d 0.75 a=1 b=1\n" % T,
+        "m %d 1000.0 a=2 b=1\n" % T]
+
+
+def test_keep(cache_dir):
+    lines = rollup([("tcp", "proc.* sum by state keep")], TCP)
+    raw = sorted("%s %d %s %s\n" % point for point in TCP)
+    assert lines == sorted(raw + [
+        "proc.net.tcp.sum %d 3 state=established\n" % T,
+        "proc.net.tcp.sum %d 4 state=time_wait\n" % T,
+        "proc.net.tcp.sum %d 8 state=established\n" % (T + 10)])
+
+
+def test_other_metrics_untouched(cache_dir):
+    points = [("proc.loadavg.1min", T, "0.5", "")] + TCP[:1]
+    assert rollup([("tcp", "proc.net.tcp sum by")], points) == [
+        "proc.loadavg.1min %d 0.5\n" % T,
+        "proc.net.tcp %d 1\n" % T]
+
+
+def test_bad_rules(cache_dir):
+    rules = opentsdb_aggregate.Rules([("a", "proc.net.tcp avg by state"),
+                                      ("b", "proc.net.tcp"),
+                                      ("c", "proc.net.tcp sum by a b"),
+                                      ("d", "proc.net.tcp sum state")])
+    # only d, "by" being optional
+    assert len(rules) == 1 and rules.rules[0].by == ["state"]
+
+
+def test_chunk_writer(cache_dir):
+    spool = opentsdb_spool.Spool(cache_dir, 1 << 30, 1 << 30)
+    parser = opentsdb_datapoint.Parser(" host=x")
+    rules = opentsdb_aggregate.Rules([("tcp", "proc.net.tcp sum by state")])
+    writer = opentsdb_checks.ChunkWriter(spool, parser, 1 << 20, rules=rules)
+    assert writer.write_text("".join("%s %d %s %s\n" % point for point in TCP)
+                             + "proc.loadavg.1min %d 0.5\n" % T)
+    writer.commit()
+    assert spool.seal()
+    name = spool.segments()[0].name
+    lines = sorted("".join(lines for _, lines in spool.read(name))
+                   .splitlines(True))
+    assert lines == [
+        "proc.loadavg.1min %d 0.5 host=x\n" % T,
+        "proc.net.tcp %d 3 state=established host=x\n" % T,
+        "proc.net.tcp %d 4 state=time_wait host=x\n" % T,
+        "proc.net.tcp %d 8 state=established host=x\n" % (T + 10)]
+
+
+TESTS = (test_sum_by, test_functions, test_several_tags_and_floats, test_keep,
+         test_other_metrics_untouched, test_bad_rules, test_chunk_writer)
+
+
+def main(argv):
+    # the bad rules are logged on purpose
+    logging.getLogger('opentsdb_checks').setLevel(logging.CRITICAL)
+    for test in TESTS:
+        cache_dir = tempfile.mkdtemp()
+        try:
+            test(cache_dir)
+        finally:
+            shutil.rmtree(cache_dir)
+        print test.__name__, "ok"
+
+
+if __name__ == "__main__":
+    main(sys.argv)
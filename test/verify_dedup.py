@@ -0,0 +1,121 @@
+#!/usr/bin/python
+"""Tries out opentsdb_dedup on its own.
+
+Usage: verify_dedup.py
+
+Feeds datapoints through a Dedup kept in a temporary cache dir and checks
+which lines it writes, holds back and flushes when series expire, also
+across a save and load of its state. Prints the name of every test that
+passed; a failure raises AssertionError.
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+import opentsdb_dedup
+from opentsdb_datapoint import Datapoint
+
+INTERVAL = 60
+T = 1000000000
+
+
+def point(ts, value, tags="a=b"):
+    return Datapoint("test.metric", ts, value, tags)
+
+
+def line(ts, value, tags="a=b"):
+    return "test.metric %d %s %s\n" % (ts, value, tags)
+
+
+def test_repeats_held_back(cache_dir):
+    dedup = opentsdb_dedup.Dedup(cache_dir, INTERVAL)
+    assert dedup.filter(point(T, 1)) == line(T, 1)
+    assert dedup.filter(point(T + 10, 1)) == ""
+    assert dedup.filter(point(T + 20, 1)) == ""
+    # written again once the interval has passed since the last write
+    assert dedup.filter(point(T + INTERVAL, 1)) == line(T + INTERVAL, 1)
+    # other series are on their own
+    assert dedup.filter(point(T + 10, 1, "a=c")) == line(T + 10, 1, "a=c")
+
+
+def test_change_writes_last_held(cache_dir):
+    dedup = opentsdb_dedup.Dedup(cache_dir, INTERVAL)
+    dedup.filter(point(T, 1))
+    dedup.filter(point(T + 10, 1))
+    dedup.filter(point(T + 20, 1))
+    # until when the old value lasted, then the new one
+    assert dedup.filter(point(T + 30, 2)) == line(T + 20, 1) + line(T + 30, 2)
+    # nothing held back: only the new value
+    assert dedup.filter(point(T + 40, 3)) == line(T + 40, 3)
+
+
+def test_suffix(cache_dir):
+    dedup = opentsdb_dedup.Dedup(cache_dir, INTERVAL)
+    assert dedup.filter(point(T, 1), " host=x") == line(T, 1, "a=b host=x")
+    assert dedup.filter(point(T + 10, 1), " host=y") == line(T + 10, 1,
+                                                              "a=b host=y")
+
+
+def test_milliseconds(cache_dir):
+    dedup = opentsdb_dedup.Dedup(cache_dir, INTERVAL)
+    ms = T * 1000
+    assert dedup.filter(point(ms, 1)) == line(ms, 1)
+    assert dedup.filter(point(ms + 10000, 1)) == ""
+    assert dedup.filter(point(ms + INTERVAL * 1000, 1)) \
+        == line(ms + INTERVAL * 1000, 1)
+
+
+def test_expire(cache_dir):
+    dedup = opentsdb_dedup.Dedup(cache_dir, INTERVAL)
+    dedup.filter(point(T, 1))
+    dedup.filter(point(T + 10, 1))
+    dedup.filter(point(T, 5, "a=c"))
+    # seen too recently
+    assert dedup.expire(T + 10 + INTERVAL - 1) == ""
+    # the held back point is flushed, the other had nothing held back
+    assert dedup.expire(T + 10 + INTERVAL + 1) == line(T + 10, 1)
+    assert not dedup.series
+    # forgotten: written as new
+    assert dedup.filter(point(T + 100, 1)) == line(T + 100, 1)
+
+
+def test_state_survives_runs(cache_dir):
+    dedup = opentsdb_dedup.Dedup(cache_dir, INTERVAL)
+    dedup.filter(point(T, 1))
+    dedup.filter(point(T + 10, 1))
+    dedup.save()
+    # the next cron run
+    dedup = opentsdb_dedup.Dedup(cache_dir, INTERVAL)
+    assert dedup.filter(point(T + 20, 1)) == ""
+    assert dedup.filter(point(T + 30, 2)) == line(T + 20, 1) + line(T + 30, 2)
+    # a damaged state file starts over
+    f = open(os.path.join(cache_dir, opentsdb_dedup.STATE), 'wb')
+    f.write("garbage")
+    f.close()
+    dedup = opentsdb_dedup.Dedup(cache_dir, INTERVAL)
+    assert dedup.series == {}
+
+
+TESTS = (test_repeats_held_back, test_change_writes_last_held, test_suffix,
+         test_milliseconds, test_expire, test_state_survives_runs)
+
+
+def main(argv):
+    # the damaged state is logged on purpose
+    logging.getLogger('opentsdb_checks').setLevel(logging.CRITICAL)
+    for test in TESTS:
+        cache_dir = tempfile.mkdtemp()
+        try:
+            test(cache_dir)
+        finally:
+            shutil.rmtree(cache_dir)
+        print test.__name__, "ok"
+
+
+if __name__ == "__main__":
+    main(sys.argv)